@@ -79,6 +79,11 @@ from .core import Error
 from .psytools import read_psytools
 from .dicom_utils import read_metadata
 from .image_data import walk_image_data, report_image_data
+from .image_data import iter_image_data, stream_image_data
+from .image_data import ImageDataStats
+from .image_data import walk_zip_image_data, report_zip_image_data
+from .image_data import report_cohort_image_data, stream_cohort_image_data
+from .image_data import tabulate_image_data, ImageDataTable
 
 from . import sanity
 
@@ -185,14 +185,28 @@ class Error:
         Message explaining the error.
     sample : str
         Data extracted from the file that caused the error.
+    code : str
+        Stable identifier of the kind of error, independent of the
+        wording of the message.
+    severity : str
+        Whether the error is blocking or a mere warning.
+    sequence : str
+        MRI sequence folder the error relates to, if not found in path.
 
     """
     _SAMPLE_LEN = 30
+    code = None  # errors pickled before codes were introduced
+    severity = None
+    sequence = None
 
-    def __init__(self, path, message, sample=None):
+    def __init__(self, path, message, sample=None, code=None, severity=None,
+                 sequence=None):
         self.path = path
         self.message = message
         self.sample = sample
+        self.code = code
+        self.severity = severity
+        self.sequence = sequence
 
     def __str__(self):
         if self.path:
@@ -201,8 +201,8 @@ def read_metadata(path, force=False):
 
     Parameters
     ----------
-    path : str
-        Path name of the DICOM file.
+    path : str or file
+        Path name of the DICOM file, or file-like object to read from.
     force : bool
         If True read nonstandard files, typically without "Part 10" headers.
 
@@ -34,14 +34,274 @@ logger = logging.getLogger(__name__)
 import os
 import time
 import datetime
+import pickle
+import json
+import hashlib
+import zlib
+import multiprocessing
+from zipfile import ZipFile
+try:
+    from zipfile import BadZipFile
+except ImportError:
+    from zipfile import BadZipfile as BadZipFile  # Python 2
+from io import BytesIO
+from array import array
 from collections import namedtuple
 from collections import Counter
 
+import numpy
+import pandas
+
 from .dicom_utils import read_metadata
 from .dicom_utils import InvalidDicomError
 
 
-def walk_image_data(path, force=False):
+Series = namedtuple('Series', ['metadata', 'images', 'duplicates', 'conflicts'])
+
+# compulsory metadata, not counted as optional metadata of a series
+_COMPULSORY_METADATA = ('SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription',
+                        'SOPInstanceUID', 'ImageType',
+                        'AcquisitionDate', 'AcquisitionTime')
+
+# file where incremental reports persist their state, next to the dataset
+_STATE_SUFFIX = '.image_data.pickle'
+_STATE_VERSION = 2
+
+# files are fingerprinted from their size and the hash of their first bytes,
+# and compared from the hash of their whole contents, read in chunks
+_FINGERPRINT_SIZE = 4096
+_DIGEST_CHUNK_SIZE = 1 << 20
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class ImageDataStats(object):
+    """Per-file timing statistics of DICOM files read from a dataset.
+
+    Statistics are split by top-level directory of the dataset and by
+    outcome of reading the file:
+
+    * 'ok',
+    * 'IOError',
+    * 'InvalidDicom',
+    * 'missing attribute'.
+
+    Files are first read into memory and then parsed, so that read
+    latency and parse time are recorded separately.
+
+    """
+    def __init__(self):
+        self._samples = {}  # (top, outcome) -> (read times, parse times, sizes)
+
+    def record(self, relpath, outcome, size, read_time, parse_time):
+        """Record timing of a single file.
+
+        Parameters
+        ----------
+        relpath : unicode
+            Path of the file relative to the dataset.
+        outcome : str
+            Outcome of reading the file.
+        size : int
+            Bytes read.
+        read_time : float
+            Time spent reading the file, in seconds.
+        parse_time : float
+            Time spent parsing DICOM metadata, in seconds.
+
+        """
+        parts = relpath.split(os.sep, 1)
+        top = parts[0] if len(parts) > 1 else os.curdir
+        key = (top, outcome)
+        if key not in self._samples:
+            self._samples[key] = (array('d'), array('d'), array('d'))
+        read_times, parse_times, sizes = self._samples[key]
+        read_times.append(read_time)
+        parse_times.append(parse_time)
+        sizes.append(size)
+
+    @staticmethod
+    def _percentiles(samples):
+        samples = sorted(samples)
+        n = len(samples)
+        return dict(('p{0}'.format(p), samples[min(n - 1, int(n * p / 100.0))])
+                    for p in (50, 95, 99))
+
+    def summary(self):
+        """Aggregate recorded timings.
+
+        Returns
+        -------
+        dict
+            Nested dictionary indexed by top-level directory then outcome.
+            Values include the number of files, the number of bytes read,
+            read throughput in MB/s and p50/p95/p99 percentiles of read
+            latency, parse time and file size.
+
+        """
+        summary = {}
+        for (top, outcome), (read_times, parse_times, sizes) in self._samples.items():
+            total_bytes = sum(sizes)
+            total_time = sum(read_times)
+            summary.setdefault(top, {})[outcome] = {
+                'files': len(sizes),
+                'bytes': int(total_bytes),
+                'throughput': (total_bytes / total_time / 1e6) if total_time else None,
+                'read': self._percentiles(read_times),
+                'parse': self._percentiles(parse_times),
+                'size': self._percentiles(sizes),
+            }
+        return summary
+
+    def dump(self, stream):
+        """Write aggregated timings to a text stream as JSON."""
+        json.dump(self.summary(), stream, indent=2, sort_keys=True)
+
+
+def _read_image(abspath, relpath, force=False, stats=None, zip_file=None):
+    """Read metadata from a DICOM file, log an error if it cannot be read.
+
+    Parameters
+    ----------
+    abspath : unicode
+        Path of the DICOM file, or name of the ZIP archive member.
+    relpath : unicode
+        Path of the DICOM file relative to the dataset, used in log messages.
+    force : bool
+        Try reading nonstandard DICOM files, typically without "PART 10" headers.
+    stats : ImageDataStats, optional
+        Record read latency, bytes read and parse time.
+    zip_file : zipfile.ZipFile, optional
+        Read the DICOM file from this ZIP archive, into memory.
+
+    Returns
+    -------
+    dict
+        Extracted DICOM metadata, None if the file could not be read.
+
+    """
+    logger.debug('read file: %s', relpath)
+    metadata = None
+    outcome = 'ok'
+    size = 0
+    start = time.time()
+    read = None
+    try:
+        if zip_file is not None:
+            data = zip_file.read(abspath)
+            size = len(data)
+            source = BytesIO(data)
+            read = time.time()
+        elif stats is None:
+            source = abspath
+        else:
+            with open(abspath, 'rb') as f:
+                data = f.read()
+            size = len(data)
+            source = BytesIO(data)
+            read = time.time()
+        metadata = read_metadata(source, force=force)
+    except IOError as e:
+        outcome = 'IOError'
+        logger.error('cannot read file (%s): %s', str(e), relpath)
+    except (BadZipFile, zlib.error, EOFError, NotImplementedError) as e:
+        outcome = 'IOError'
+        logger.error('cannot unzip file (%s): %s', str(e), relpath)
+    except InvalidDicomError as e:
+        outcome = 'InvalidDicom'
+        logger.error('cannot read nonstandard DICOM file: %s: %s', str(e), relpath)
+    except AttributeError as e:
+        outcome = 'missing attribute'
+        logger.error('missing attribute: %s: %s', str(e), relpath)
+    if stats is not None:
+        end = time.time()
+        if read is None:  # failed to read file
+            stats.record(relpath, outcome, size, end - start, 0.0)
+        else:
+            stats.record(relpath, outcome, size, read - start, end - read)
+    return metadata
+
+
+def _walk_files(path):
+    """Generate files in a directory, except DICOMDIR files.
+
+    Yields
+    ------
+    tuple
+        Yields a pair (abspath, relpath).
+
+    """
+    for root, dummy_dirs, files in os.walk(path):
+        for filename in files:
+            # skip DICOMDIR since we are going to read all DICOM files anyway
+            if filename == 'DICOMDIR':
+                continue
+            abspath = os.path.join(root, filename)
+            relpath = os.path.normpath(os.path.relpath(abspath, path))
+            yield abspath, relpath
+
+
+def _fingerprint(abspath):
+    """Cheap fingerprint of the contents of a file.
+
+    Returns
+    -------
+    tuple
+        Pair (size, digest) where digest is a hash of the first bytes
+        of the file. DICOM headers, including the 'SOPInstanceUID',
+        are found at the beginning of files.
+
+    """
+    with open(abspath, 'rb') as f:
+        head = f.read(_FINGERPRINT_SIZE)
+        size = os.fstat(f.fileno()).st_size
+    return size, hashlib.sha1(head).hexdigest()
+
+
+def _digest(abspath):
+    """Hash of the whole contents of a file.
+
+    Returns
+    -------
+    tuple
+        Pair (size, digest) where digest is a hash of the contents of the file.
+
+    """
+    h = hashlib.sha1()
+    size = 0
+    with open(abspath, 'rb') as f:
+        while True:
+            chunk = f.read(_DIGEST_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            h.update(chunk)
+    return size, h.hexdigest()
+
+
+def _identical_files(path):
+    """Function comparing the contents of two files of a dataset.
+
+    Files are compared from the hash of their whole contents. Hashes are
+    cached, since the same original may be compared to many copies.
+
+    """
+    digests = {}
+
+    def digest(relpath):
+        if relpath not in digests:
+            digests[relpath] = _digest(os.path.join(path, relpath))
+        return digests[relpath]
+
+    def identical(relpath, other):
+        try:
+            return digest(relpath) == digest(other)
+        except (IOError, OSError):
+            return False
+    return identical
+
+
+def walk_image_data(path, force=False, stats=None):
     """Generate information on DICOM files in a directory.
 
     File that cannot be read are skipped and an error message is logged.
@@ -52,6 +312,8 @@ def walk_image_data(path, force=False):
         Directory to read DICOM files from.
     force : bool
         Try reading nonstandard DICOM files, typically without "PART 10" headers.
+    stats : ImageDataStats, optional
+        Record per-file timing statistics.
 
     Yields
     ------
@@ -65,31 +327,391 @@ def walk_image_data(path, force=False):
 
     logger.info('start processing files: %s', path)
 
-    for root, dummy_dirs, files in os.walk(path):
-        n += len(files)
-        for filename in files:
-            abspath = os.path.join(root, filename)
-            relpath = os.path.normpath(os.path.relpath(abspath, path))
-            # skip DICOMDIR since we are going to read all DICOM files anyway
+    for abspath, relpath in _walk_files(path):
+        n += 1
+        metadata = _read_image(abspath, relpath, force=force, stats=stats)
+        if metadata is not None:
+            yield (metadata, relpath)
+
+    elapsed = time.time() - start
+    logger.info('processed %d files in %.2f s: %s', n, elapsed, path)
+
+
+def _timestamp(metadata):
+    """Acquisition date and time of a DICOM image.
+
+    Parameters
+    ----------
+    metadata : dict
+        Metadata extracted from a DICOM file.
+
+    Returns
+    -------
+    datetime.datetime
+        None if the acquisition date is unknown.
+
+    """
+    acquisition_date = metadata.get('AcquisitionDate')
+    if not acquisition_date:
+        return None
+    acquisition_time = metadata.get('AcquisitionTime')
+    if acquisition_time:
+        return datetime.datetime.combine(acquisition_date, acquisition_time)
+    else:
+        return datetime.datetime(acquisition_date.year,
+                                 acquisition_date.month,
+                                 acquisition_date.day)
+
+
+def _add_image(series_dict, metadata, relpath, identical=None):
+    """Add a DICOM image to a dictionary of series.
+
+    An image with the same 'SOPInstanceUID' as an image already added to
+    the series is recorded as a duplicate, either identical or conflicting,
+    and ignored otherwise.
+
+    Parameters
+    ----------
+    series_dict : dict
+        The key identifies a series while the value is a Series named tuple.
+    metadata : dict
+        Metadata extracted from the DICOM file.
+    relpath : unicode
+        Path of the DICOM file relative to the dataset.
+    identical : callable, optional
+        Compare two files from their relpath, return True if identical.
+        By default, duplicates are considered conflicting.
+
+    """
+    # compulsory metadata
+    series_uid = metadata['SeriesInstanceUID']
+    image_uid = metadata['SOPInstanceUID']
+    series_number = metadata['SeriesNumber']
+    series_description = metadata['SeriesDescription']
+    image_types = metadata['ImageType']
+    timestamp = _timestamp(metadata)
+
+    # build the dictionnary of series using 'SeriesInstanceUID' as a key
+    if series_uid not in series_dict:
+        series_metadata = {
+            'SeriesNumber': Counter([series_number]),
+            'SeriesDescription': Counter([series_description]),
+            'ImageType': Counter(x for x in image_types),
+            'MinAcquisitionDateTime': timestamp,
+            'MaxAcquisitionDateTime': timestamp,
+        }
+        series_dict[series_uid] = Series(series_metadata, {image_uid: relpath}, {}, {})
+    elif image_uid in series_dict[series_uid].images:
+        # another file with the same 'SOPInstanceUID' has already been added
+        series = series_dict[series_uid]
+        original = series.images[image_uid]
+        if identical and identical(original, relpath):
+            logger.debug('identical duplicate: %s: %s', original, relpath)
+            series.duplicates[relpath] = original
+        else:
+            logger.warning('conflicting duplicate image: %s: %s', original, relpath)
+            series.conflicts.setdefault(image_uid, []).append(relpath)
+        return
+    else:
+        series = series_dict[series_uid]
+        series.metadata['SeriesNumber'].update([series_number])
+        series.metadata['SeriesDescription'].update([series_description])
+        series.metadata['ImageType'].update(x for x in image_types)
+        if timestamp:
+            minimum = series.metadata['MinAcquisitionDateTime']
+            if minimum is None or timestamp < minimum:
+                series.metadata['MinAcquisitionDateTime'] = timestamp
+            maximum = series.metadata['MaxAcquisitionDateTime']
+            if maximum is None or timestamp > maximum:
+                series.metadata['MaxAcquisitionDateTime'] = timestamp
+        series.images[image_uid] = relpath
+
+    # optional metadata
+    series_metadata = series_dict[series_uid].metadata
+    for x in metadata:
+        if x not in _COMPULSORY_METADATA:
+            if x in series_metadata:
+                series_metadata[x].update([metadata[x]])
+            else:
+                series_metadata[x] = Counter([metadata[x]])
+
+
+def _remove_image(series_dict, metadata, relpath, files, identical=None):
+    """Remove a DICOM image previously added to a dictionary of series.
+
+    If the removed image is replaced neither by an identical copy nor by
+    a conflicting file, the first conflicting file becomes the image and
+    the other conflicting files are compared to it again.
+
+    Parameters
+    ----------
+    series_dict : dict
+        The key identifies a series while the value is a Series named tuple.
+    metadata : dict
+        Metadata extracted from the DICOM file when it was added.
+    relpath : unicode
+        Path of the DICOM file relative to the dataset.
+    files : dict
+        Maps relpath of remaining files to a tuple (size, mtime, metadata),
+        used to recompute acquisition time boundaries of the series and
+        to add conflicting files again.
+    identical : callable, optional
+        Compare two files from their relpath, return True if identical.
+
+    """
+    series_uid = metadata['SeriesInstanceUID']
+    image_uid = metadata['SOPInstanceUID']
+    series = series_dict.get(series_uid)
+    if series is None:
+        return
+
+    # duplicates did not contribute to series metadata
+    if relpath in series.duplicates:
+        del series.duplicates[relpath]
+        return
+    if relpath in series.conflicts.get(image_uid, ()):
+        series.conflicts[image_uid].remove(relpath)
+        if not series.conflicts[image_uid]:
+            del series.conflicts[image_uid]
+        return
+    if series.images.get(image_uid) == relpath:
+        copies = sorted(x for x, original in series.duplicates.items()
+                        if original == relpath)
+        if copies:
+            # an identical copy replaces the removed file
+            series.images[image_uid] = copies[0]
+            for x in copies:
+                del series.duplicates[x]
+            for x in copies[1:]:
+                series.duplicates[x] = copies[0]
+            return
+        del series.images[image_uid]
+        conflicts = series.conflicts.pop(image_uid, [])
+    else:
+        conflicts = []
+    if series.images:
+        _discard_image(series, metadata, files)
+    else:
+        del series_dict[series_uid]
+
+    # conflicting files did not contribute to series metadata, add them again
+    for x in conflicts:
+        if x in files and files[x][2] is not None:
+            _add_image(series_dict, files[x][2], x, identical)
+
+
+def _discard_image(series, metadata, files):
+    """Remove the contribution of a DICOM image from series metadata."""
+
+    def discard(key, values):
+        series.metadata[key] = series.metadata[key] - Counter(values)
+        if not series.metadata[key] and key not in ('SeriesNumber',
+                                                    'SeriesDescription',
+                                                    'ImageType'):
+            del series.metadata[key]
+
+    discard('SeriesNumber', [metadata['SeriesNumber']])
+    discard('SeriesDescription', [metadata['SeriesDescription']])
+    discard('ImageType', metadata['ImageType'])
+    for x in metadata:
+        if x not in _COMPULSORY_METADATA and x in series.metadata:
+            discard(x, [metadata[x]])
+
+    # acquisition time boundaries cannot be updated incrementally
+    timestamp = _timestamp(metadata)
+    if timestamp and timestamp in (series.metadata['MinAcquisitionDateTime'],
+                                   series.metadata['MaxAcquisitionDateTime']):
+        timestamps = [_timestamp(files[x][2]) for x in series.images.values()
+                      if x in files]
+        timestamps = [x for x in timestamps if x]
+        series.metadata['MinAcquisitionDateTime'] = min(timestamps) if timestamps else None
+        series.metadata['MaxAcquisitionDateTime'] = max(timestamps) if timestamps else None
+
+
+def _load_state(state_path, force):
+    """Load the state persisted by a previous incremental report.
+
+    Parameters
+    ----------
+    state_path : unicode
+        File where the state has been persisted.
+    force : bool
+        The state is discarded unless it was built with the same option.
+
+    Returns
+    -------
+    tuple
+        Pair (files, series_dict) where files maps the relpath of each file
+        to a tuple (size, mtime, metadata) and series_dict is the dictionary
+        of series built from these files. Both are empty if there is no
+        usable state.
+
+    """
+    try:
+        with open(state_path, 'rb') as f:
+            state = pickle.load(f)
+    except (IOError, OSError):
+        return {}, {}
+    except Exception as e:  # unpickling can fail in so many ways
+        logger.warning('discard unreadable state (%s): %s', str(e), state_path)
+        return {}, {}
+    if state.get('version') != _STATE_VERSION or state.get('force') != force:
+        logger.info('discard obsolete state: %s', state_path)
+        return {}, {}
+    return state['files'], state['series']
+
+
+def _save_state(state_path, force, files, series_dict):
+    """Persist the state of an incremental report.
+
+    The state file is replaced atomically, so that an interrupted report
+    leaves the previous state untouched.
+
+    """
+    state = {
+        'version': _STATE_VERSION,
+        'force': force,
+        'files': files,
+        'series': series_dict,
+    }
+    temp_path = state_path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=2)
+        os.rename(temp_path, state_path)
+    except (IOError, OSError) as e:
+        logger.error('cannot save state (%s): %s', str(e), state_path)
+
+
+def _report_image_data_incremental(path, force=False):
+    """Update the report of a dataset from the state of the previous report.
+
+    Only files that have been added or modified since the previous report
+    are read. Files that have been removed or modified are removed from
+    the persisted series first.
+
+    """
+    state_path = os.path.normpath(path) + _STATE_SUFFIX
+    files, series_dict = _load_state(state_path, force)
+
+    # stat current files
+    current = {}
+    for root, dummy_dirs, filenames in os.walk(path):
+        for filename in filenames:
             if filename == 'DICOMDIR':
                 continue
-            logger.debug('read file: %s', relpath)
+            abspath = os.path.join(root, filename)
+            relpath = os.path.normpath(os.path.relpath(abspath, path))
             try:
-                metadata = read_metadata(abspath, force=force)
-            except IOError as e:
-                logger.error('cannot read file (%s): %s', str(e), relpath)
-            except InvalidDicomError as e:
-                logger.error('cannot read nonstandard DICOM file: %s: %s', str(e), relpath)
-            except AttributeError as e:
-                logger.error('missing attribute: %s: %s', str(e), relpath)
+                st = os.stat(abspath)
+            except OSError as e:
+                logger.error('cannot stat file (%s): %s', str(e), relpath)
+                continue
+            current[relpath] = (st.st_size, st.st_mtime)
+
+    # drop removed or modified files from persisted series
+    identical = _identical_files(path)
+    stale = [relpath for relpath, (size, mtime, dummy_metadata) in files.items()
+             if current.get(relpath) != (size, mtime)]
+    for relpath in stale:
+        metadata = files.pop(relpath)[2]
+        if metadata is not None:
+            _remove_image(series_dict, metadata, relpath, files, identical)
+
+    # read added or modified files only
+    added = [relpath for relpath in current if relpath not in files]
+    logger.info('incremental report: %d files removed or modified, %d files to read: %s',
+                len(stale), len(added), path)
+    for relpath in added:
+        metadata = _read_image(os.path.join(path, relpath), relpath, force=force)
+        size, mtime = current[relpath]
+        # remember unreadable files as well, to avoid reading them again
+        files[relpath] = (size, mtime, metadata)
+        if metadata is not None:
+            _add_image(series_dict, metadata, relpath, identical)
+
+    if stale or added:
+        _save_state(state_path, force, files, series_dict)
+
+    return series_dict
+
+
+def _sample_indices(n, k):
+    """Indices of at most k items evenly spaced among n items.
+
+    The first and last items are always part of the sample.
+
+    """
+    if k >= n:
+        return list(range(n))
+    elif k == 1:
+        return [0]
+    else:
+        return sorted(set(int(round(i * (n - 1) / float(k - 1)))
+                          for i in range(k)))
+
+
+def _report_image_data_sample(path, sample, force=False):
+    """Report series from a sample of DICOM files in each directory.
+
+    At most `sample` files are read in each directory. If all sampled files
+    of a directory belong to the same series, the number of images of the
+    series is estimated from the number of files in the directory. Otherwise
+    the directory is flagged for a full read.
+
+    """
+    series_dict = {}
+
+    n = 0
+    start = time.time()
+
+    logger.info('start sampling files: %s', path)
+
+    for root, dummy_dirs, files in os.walk(path):
+        files = sorted(f for f in files if f != 'DICOMDIR')
+        if not files:
+            continue
+        reldir = os.path.normpath(os.path.relpath(root, path))
+
+        sampled = []
+        unreadable = 0
+        for i in _sample_indices(len(files), sample):
+            abspath = os.path.join(root, files[i])
+            relpath = os.path.normpath(os.path.relpath(abspath, path))
+            metadata = _read_image(abspath, relpath, force=force)
+            n += 1
+            if metadata is None:
+                unreadable += 1
             else:
-                yield (metadata, relpath)
+                sampled.append((metadata, relpath))
+        if not sampled:
+            logger.debug('no DICOM file found in sample: %s', reldir)
+            continue
+
+        for metadata, relpath in sampled:
+            _add_image(series_dict, metadata, relpath)
+
+        series_uids = set(metadata['SeriesInstanceUID'] for metadata, dummy in sampled)
+        if len(series_uids) == 1 and not unreadable:
+            series_metadata = series_dict[series_uids.pop()].metadata
+            series_metadata['EstimatedImages'] = (series_metadata.get('EstimatedImages', 0) +
+                                                  len(files))
+        else:
+            logger.warning('inconsistent sample, full read required: %s', reldir)
+            for metadata, dummy in sampled:
+                series_metadata = series_dict[metadata['SeriesInstanceUID']].metadata
+                series_metadata['EstimatedImages'] = series_metadata.get('EstimatedImages', 0) + 1
+                full_read = series_metadata.setdefault('FullRead', [])
+                if reldir not in full_read:
+                    full_read.append(reldir)
 
     elapsed = time.time() - start
-    logger.info('processed %d files in %.2f s: %s', n, elapsed, path)
+    logger.info('sampled %d files in %.2f s: %s', n, elapsed, path)
+
+    return series_dict
 
 
-def report_image_data(path, force=False):
+def report_image_data(path, force=False, incremental=False, sample=None):
     """Find DICOM files loosely organized according to the c-VEDA SOPs.
 
     The c-VEDA FU2 SOPs define a precise file organization for Image Data. In
@@ -100,12 +722,32 @@ def report_image_data(path, force=False):
     This function scans the directory where we expect to find the Image Data
     of a dataset and reports series of valid DICOM files.
 
+    In incremental mode, the state of the report is persisted in a file next
+    to the dataset directory, with suffix *.image_data.pickle*. Subsequent
+    reports read only files added or modified since the previous report.
+
+    In sampling mode, only a few files are read in each directory, enough
+    for a quick triage of the series of a dataset. Series metadata then
+    include an estimation of the number of images ('EstimatedImages') and,
+    if the sampled files of a directory disagree, a list of directories
+    that require a full read ('FullRead').
+
+    Identical copies of DICOM files are first spotted from their size and the
+    hash of their first bytes, then confirmed from the hash of their whole
+    contents. They are not parsed, but listed in the 'duplicates' field of
+    the relevant series. Different DICOM files sharing the same
+    'SOPInstanceUID' are listed in the 'conflicts' field of the series.
+
     Parameters
     ----------
     path : unicode
         Directory to read DICOM files from.
     force : bool
         Try reading nonstandard DICOM files, typically without "PART 10" headers.
+    incremental : bool
+        Persist the report and update it from the previous report.
+    sample : int, optional
+        Read at most this number of files in each directory.
 
     Returns
     -------
@@ -113,57 +755,583 @@ def report_image_data(path, force=False):
         The key identifies a series while the value is a Series named tuple.
 
     """
-    Series = namedtuple('Series', ['metadata', 'images'])
+    if sample:
+        return _report_image_data_sample(path, sample, force=force)
+    if incremental:
+        return _report_image_data_incremental(path, force=force)
 
     series_dict = {}
+    fingerprints = {}  # fingerprint -> list of (series UID, relpath) of images
+    identical = _identical_files(path)
 
-    for (metadata, relpath) in walk_image_data(path, force=force):
-        # compulsory metadata
+    n = 0
+    start = time.time()
+
+    logger.info('start processing files: %s', path)
+
+    for abspath, relpath in _walk_files(path):
+        n += 1
+        try:
+            fingerprint = _fingerprint(abspath)
+        except (IOError, OSError):
+            fingerprint = None  # let _read_image() report the error
+        else:
+            originals = [x for x in fingerprints.get(fingerprint, ())
+                         if identical(x[1], relpath)]
+            if originals:
+                series_uid, original = originals[0]
+                logger.debug('skip identical duplicate: %s: %s', original, relpath)
+                series_dict[series_uid].duplicates[relpath] = original
+                continue
+        metadata = _read_image(abspath, relpath, force=force)
+        if metadata is None:
+            continue
+        _add_image(series_dict, metadata, relpath)
+        # copies of conflicting files are read and listed as conflicts too
         series_uid = metadata['SeriesInstanceUID']
         image_uid = metadata['SOPInstanceUID']
-        series_number = metadata['SeriesNumber']
-        series_description = metadata['SeriesDescription']
-        image_types = metadata['ImageType']
-        if 'AcquisitionDate' in metadata:
-            acquisition_date = metadata['AcquisitionDate']
-            if 'AcquisitionTime' in metadata:
-                acquisition_time = metadata['AcquisitionTime']
-                timestamp = datetime.datetime.combine(acquisition_date,
-                                                      acquisition_time)
-            else:
-                timestamp = datetime.datetime(acquisition_date.year,
-                                              acquisition_date.month,
-                                              acquisition_date.day)
-
-        # build the dictionnary of series using 'SeriesInstanceUID' as a key
-        if series_uid not in series_dict:
-            metadata = {
-                'SeriesNumber': Counter([series_number]),
-                'SeriesDescription': Counter([series_description]),
-                'ImageType': Counter(x for x in image_types),
-                'MinAcquisitionDateTime': timestamp,
-                'MaxAcquisitionDateTime': timestamp,
-            }
-            series_dict[series_uid] = Series(metadata, {image_uid: relpath})
-        else:
-            series_dict[series_uid].metadata['SeriesNumber'].update([series_number])
-            series_dict[series_uid].metadata['SeriesDescription'].update([series_description])
-            series_dict[series_uid].metadata['ImageType'].update(x for x in image_types)
-            if timestamp < series_dict[series_uid].metadata['MinAcquisitionDateTime']:
-                series_dict[series_uid].metadata['MinAcquisitionDateTime'] = timestamp
-            if timestamp > series_dict[series_uid].metadata['MaxAcquisitionDateTime']:
-                series_dict[series_uid].metadata['MaxAcquisitionDateTime'] = timestamp
-            # FIXME: detect duplicate 'image_uid'?
-            series_dict[series_uid].files[image_uid] = relpath
-
-        # optional metadata
-        for x in metadata:
-            if x not in ('SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription',
-                         'SOPInstanceUID', 'ImageType',
-                         'AcquisitionDate', 'AcquisitionTime'):
-                if x in series_dict[series_uid].metadata:
-                    series_dict[series_uid].metadata[x].update([metadata[x]])
-                else:
-                    series_dict[series_uid].metadata[x] = Counter([metadata[x]])
+        if fingerprint and series_dict[series_uid].images.get(image_uid) == relpath:
+            fingerprints.setdefault(fingerprint, []).append((series_uid, relpath))
+
+    elapsed = time.time() - start
+    logger.info('processed %d files in %.2f s: %s', n, elapsed, path)
+
+    return series_dict
+
+
+def _zip_members(zip_file):
+    """Generate members of a ZIP archive, except directories and DICOMDIR files.
+
+    Yields
+    ------
+    zipfile.ZipInfo
+
+    """
+    for zipinfo in zip_file.infolist():
+        if zipinfo.filename.endswith('/'):
+            continue
+        # skip DICOMDIR since we are going to read all DICOM files anyway
+        if zipinfo.filename.rsplit('/', 1)[-1] == 'DICOMDIR':
+            continue
+        yield zipinfo
+
+
+def walk_zip_image_data(path, force=False, stats=None):
+    """Generate information on DICOM files in a ZIP archive.
+
+    Archive members are read into memory, without extracting the archive.
+    Members that cannot be read are skipped and an error message is logged.
+
+    Parameters
+    ----------
+    path : unicode
+        ZIP archive to read DICOM files from.
+    force : bool
+        Try reading nonstandard DICOM files, typically without "PART 10" headers.
+    stats : ImageDataStats, optional
+        Record per-file timing statistics.
+
+    Yields
+    ------
+    tuple
+        Yields a pair (metadata, relpath) where metadata is a dictionary
+        of extracted DICOM metadata and relpath the name of the member.
+
+    """
+    n = 0
+    start = time.time()
+
+    logger.info('start processing archive: %s', path)
+
+    with ZipFile(path, 'r') as zip_file:
+        for zipinfo in _zip_members(zip_file):
+            n += 1
+            relpath = zipinfo.filename
+            metadata = _read_image(relpath, relpath, force=force, stats=stats,
+                                   zip_file=zip_file)
+            if metadata is not None:
+                yield (metadata, relpath)
+
+    elapsed = time.time() - start
+    logger.info('processed %d files in %.2f s: %s', n, elapsed, path)
+
+
+def report_zip_image_data(path, force=False):
+    """Find DICOM files in a ZIP archive, without extracting the archive.
+
+    This is the counterpart of :func:`report_image_data` for ZIP archives.
+    Relative paths of DICOM files are the names of archive members.
+
+    Files with the same 'SOPInstanceUID' are considered identical copies
+    if their archive members have the same size and CRC-32, and conflicting
+    otherwise.
+
+    Parameters
+    ----------
+    path : unicode
+        ZIP archive to read DICOM files from.
+    force : bool
+        Try reading nonstandard DICOM files, typically without "PART 10" headers.
+
+    Returns
+    -------
+    dict
+        The key identifies a series while the value is a Series named tuple.
+
+    """
+    series_dict = {}
+    fingerprints = {}  # relpath -> (size, CRC-32)
+
+    def identical(original, relpath):
+        return fingerprints[original] == fingerprints[relpath]
+
+    n = 0
+    start = time.time()
+
+    logger.info('start processing archive: %s', path)
+
+    with ZipFile(path, 'r') as zip_file:
+        for zipinfo in _zip_members(zip_file):
+            n += 1
+            relpath = zipinfo.filename
+            metadata = _read_image(relpath, relpath, force=force,
+                                   zip_file=zip_file)
+            if metadata is None:
+                continue
+            fingerprints[relpath] = (zipinfo.file_size, zipinfo.CRC)
+            _add_image(series_dict, metadata, relpath, identical)
+
+    elapsed = time.time() - start
+    logger.info('processed %d files in %.2f s: %s', n, elapsed, path)
 
     return series_dict
+
+
+def iter_image_data(path, force=False):
+    """Generate series of DICOM files as soon as they are complete.
+
+    Directories are traversed bottom-up, so that the subtree of a directory
+    has been fully traversed once its own files have been read. Series found
+    in a directory are then complete and generated. Only series of the
+    current directory are kept in memory.
+
+    A series split across several directories, siblings or a directory and
+    its parent, is generated once for each of these directories. Parts after
+    the first one are flagged with a 'SplitDirectories' metadata listing the
+    directories of the previous parts, so that they can be merged downstream.
+
+    Parameters
+    ----------
+    path : unicode
+        Directory to read DICOM files from.
+    force : bool
+        Try reading nonstandard DICOM files, typically without "PART 10" headers.
+
+    Yields
+    ------
+    tuple
+        Yields a pair (series_uid, series) where series is a Series named tuple.
+
+    """
+    completed = {}  # series UID -> directories of series already generated
+    identical = _identical_files(path)
+
+    n = 0
+    start = time.time()
+
+    logger.info('start processing files: %s', path)
+
+    for root, dummy_dirs, files in os.walk(path, topdown=False):
+        reldir = os.path.normpath(os.path.relpath(root, path))
+        series_dict = {}
+        n += len(files)
+        for filename in sorted(files):
+            if filename == 'DICOMDIR':
+                continue
+            abspath = os.path.join(root, filename)
+            relpath = os.path.normpath(os.path.relpath(abspath, path))
+            metadata = _read_image(abspath, relpath, force=force)
+            if metadata is None:
+                continue
+            _add_image(series_dict, metadata, relpath, identical)
+
+        # subtree of current directory has now been traversed
+        for series_uid in sorted(series_dict):
+            series = series_dict[series_uid]
+            if series_uid in completed:
+                logger.warning('series split across directories: %s: %s',
+                               series_uid, reldir)
+                series.metadata['SplitDirectories'] = list(completed[series_uid])
+            completed.setdefault(series_uid, []).append(reldir)
+            yield series_uid, series
+
+    elapsed = time.time() - start
+    logger.info('processed %d files in %.2f s: %s', n, elapsed, path)
+
+
+def _json_default(o):
+    """Serialize DICOM values and date/time objects in JSON."""
+    if isinstance(o, (datetime.date, datetime.time)):
+        return o.isoformat()
+    return u'{0}'.format(o)
+
+
+def _series_record(series_uid, series):
+    """Convert a series into a JSON serializable dictionary.
+
+    Counters are converted into lists of [value, count] pairs, since
+    DICOM values cannot always be used as JSON keys.
+
+    """
+    metadata = {}
+    for key, value in series.metadata.items():
+        if isinstance(value, Counter):
+            metadata[key] = [[x, count] for x, count in value.most_common()]
+        else:
+            metadata[key] = value
+    return {
+        'SeriesInstanceUID': series_uid,
+        'metadata': metadata,
+        'images': series.images,
+        'duplicates': series.duplicates,
+        'conflicts': series.conflicts,
+    }
+
+
+def stream_image_data(path, stream, force=False):
+    """Write series of DICOM files as JSON lines as soon as they are complete.
+
+    Each complete series is written as a JSON object on a line of its own.
+    A series split across directories is written once for each directory,
+    see :func:`iter_image_data`. A final line with a 'summary' object closes
+    the stream.
+
+    Parameters
+    ----------
+    path : unicode
+        Directory to read DICOM files from.
+    stream : file
+        Text stream to write JSON lines to.
+    force : bool
+        Try reading nonstandard DICOM files, typically without "PART 10" headers.
+
+    Returns
+    -------
+    dict
+        The summary written at the end of the stream.
+
+    """
+    start = time.time()
+    series_count = 0
+    image_count = 0
+
+    for series_uid, series in iter_image_data(path, force=force):
+        if 'SplitDirectories' not in series.metadata:
+            series_count += 1
+        image_count += len(series.images)
+        stream.write(json.dumps(_series_record(series_uid, series),
+                                default=_json_default, sort_keys=True) + '\n')
+        stream.flush()
+
+    summary = {
+        'path': path,
+        'series': series_count,
+        'images': image_count,
+        'elapsed': round(time.time() - start, 3),
+    }
+    stream.write(json.dumps({'summary': summary}, sort_keys=True) + '\n')
+    stream.flush()
+
+    return summary
+
+
+def _read_image_task(task):
+    """Read metadata from a DICOM file in a worker process."""
+    index, abspath, relpath, force = task
+    return index, relpath, _read_image(abspath, relpath, force=force)
+
+
+def report_cohort_image_data(paths, force=False, processes=None):
+    """Report series of DICOM files for many datasets on a shared process pool.
+
+    Files of all datasets are read by a single pool of worker processes.
+    Largest datasets are scheduled first, to avoid leaving workers idle
+    at the end while a large dataset is being processed. The report of
+    each dataset is generated as soon as all its files have been read.
+
+    Parameters
+    ----------
+    paths : iterable
+        Directories to read DICOM files from, one per dataset.
+    force : bool
+        Try reading nonstandard DICOM files, typically without "PART 10" headers.
+    processes : int, optional
+        Number of worker processes, by default the number of CPUs.
+
+    Yields
+    ------
+    tuple
+        Yields a pair (path, series_dict) where series_dict is the report
+        of the dataset, as returned by :func:`report_image_data`.
+
+    """
+    start = time.time()
+
+    # list files of each dataset
+    datasets = []
+    for path in paths:
+        files = []
+        size = 0
+        for abspath, relpath in _walk_files(path):
+            files.append((abspath, relpath))
+            try:
+                size += os.path.getsize(abspath)
+            except OSError:
+                pass  # let _read_image() report the error
+        datasets.append((size, path, files))
+    datasets.sort(key=lambda x: x[0], reverse=True)
+    logger.info('start processing %d datasets, %d files',
+                len(datasets), sum(len(files) for size, path, files in datasets))
+
+    remaining = {}
+    series_dicts = {}
+    for index, (size, path, files) in enumerate(datasets):
+        if files:
+            remaining[index] = len(files)
+            series_dicts[index] = {}
+        else:
+            logger.warning('no files found: %s', path)
+            yield path, {}
+
+    def tasks():
+        for index, (size, path, files) in enumerate(datasets):
+            for abspath, relpath in files:
+                yield index, abspath, relpath, force
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for index, relpath, metadata in pool.imap_unordered(_read_image_task,
+                                                            tasks(),
+                                                            chunksize=16):
+            path = datasets[index][1]
+            if metadata is not None:
+                _add_image(series_dicts[index], metadata, relpath,
+                           _identical_files(path))
+            remaining[index] -= 1
+            if not remaining[index]:
+                del remaining[index]
+                logger.info('processed %d files: %s', len(datasets[index][2]), path)
+                datasets[index] = (datasets[index][0], path, None)  # release memory
+                yield path, series_dicts.pop(index)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    elapsed = time.time() - start
+    logger.info('processed %d datasets in %.2f s', len(datasets), elapsed)
+
+
+def stream_cohort_image_data(paths, stream, force=False, processes=None):
+    """Write reports of many datasets as JSON lines as soon as they are complete.
+
+    Each dataset is written as a JSON object on a line of its own, with
+    the path of the dataset and the list of its series. A final line with
+    a 'summary' object closes the stream.
+
+    Parameters
+    ----------
+    paths : iterable
+        Directories to read DICOM files from, one per dataset.
+    stream : file
+        Text stream to write JSON lines to.
+    force : bool
+        Try reading nonstandard DICOM files, typically without "PART 10" headers.
+    processes : int, optional
+        Number of worker processes, by default the number of CPUs.
+
+    Returns
+    -------
+    dict
+        The summary written at the end of the stream.
+
+    """
+    start = time.time()
+    dataset_count = 0
+    series_count = 0
+    image_count = 0
+
+    for path, series_dict in report_cohort_image_data(paths, force=force,
+                                                      processes=processes):
+        dataset_count += 1
+        series_count += len(series_dict)
+        image_count += sum(len(series.images) for series in series_dict.values())
+        record = {
+            'path': path,
+            'series': [_series_record(series_uid, series)
+                       for series_uid, series in series_dict.items()],
+        }
+        stream.write(json.dumps(record, default=_json_default, sort_keys=True) + '\n')
+        stream.flush()
+
+    summary = {
+        'datasets': dataset_count,
+        'series': series_count,
+        'images': image_count,
+        'elapsed': round(time.time() - start, 3),
+    }
+    stream.write(json.dumps({'summary': summary}, sort_keys=True) + '\n')
+    stream.flush()
+
+    return summary
+
+
+class ImageDataTable(object):
+    """Columnar store of metadata extracted from DICOM images.
+
+    Each image is appended as a row of typed column arrays. Repetitive
+    metadata such as series descriptions, station names or software
+    versions are stored as integer codes into a table of categories.
+    This keeps memory usage bounded for very large scans, compared with
+    a dictionary of series holding a Counter per metadata field.
+
+    """
+    _CATEGORICAL = ('SeriesInstanceUID', 'SeriesDescription', 'ImageType',
+                    'StationName', 'Manufacturer', 'ManufacturerModelName',
+                    'DeviceSerialNumber', 'SoftwareVersions', 'PatientID',
+                    'Directory')
+
+    # summarized by their most common value within each series
+    _SUMMARY = ('SeriesNumber', 'SeriesDescription',
+                'StationName', 'Manufacturer', 'ManufacturerModelName',
+                'DeviceSerialNumber', 'SoftwareVersions', 'PatientID',
+                'Directory')
+
+    def __init__(self):
+        self._codes = dict((name, array('l')) for name in self._CATEGORICAL)
+        self._categories = dict((name, ({}, [])) for name in self._CATEGORICAL)
+        self._series_number = array('l')
+        self._timestamp = array('d')
+        self._image_uid = []
+        self._filename = []
+
+    def __len__(self):
+        return len(self._image_uid)
+
+    def _encode(self, name, value):
+        if value is None:
+            code = -1
+        else:
+            if isinstance(value, (list, tuple)):
+                value = u'\\'.join(u'{0}'.format(x) for x in value)
+            else:
+                value = u'{0}'.format(value)
+            index, values = self._categories[name]
+            code = index.get(value)
+            if code is None:
+                code = len(values)
+                index[value] = code
+                values.append(value)
+        self._codes[name].append(code)
+
+    def append(self, metadata, relpath):
+        """Append a DICOM image.
+
+        Parameters
+        ----------
+        metadata : dict
+            Metadata extracted from the DICOM file.
+        relpath : unicode
+            Path of the DICOM file relative to the dataset.
+
+        """
+        directory, filename = os.path.split(relpath)
+        self._encode('Directory', directory)
+        for name in self._CATEGORICAL:
+            if name != 'Directory':
+                self._encode(name, metadata.get(name))
+        series_number = metadata.get('SeriesNumber')
+        self._series_number.append(-1 if series_number is None
+                                   else int(series_number))
+        timestamp = _timestamp(metadata)
+        self._timestamp.append(float('nan') if timestamp is None
+                               else (timestamp - _EPOCH).total_seconds())
+        self._image_uid.append(metadata['SOPInstanceUID'])
+        self._filename.append(filename)
+
+    def images(self):
+        """Metadata of DICOM images as a table.
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per image, categorical columns for repetitive metadata.
+
+        """
+        columns = {
+            'SOPInstanceUID': self._image_uid,
+            'Filename': self._filename,
+            'SeriesNumber': pandas.Series(numpy.asarray(self._series_number),
+                                          dtype='Int64').replace(-1, pandas.NA),
+            'AcquisitionDateTime': pandas.to_datetime(numpy.asarray(self._timestamp),
+                                                      unit='s'),
+        }
+        for name in self._CATEGORICAL:
+            columns[name] = pandas.Categorical.from_codes(
+                numpy.asarray(self._codes[name]),
+                categories=self._categories[name][1])
+        return pandas.DataFrame(columns)
+
+    def series(self):
+        """Summary of DICOM series as a table.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Indexed by SeriesInstanceUID, one row per series with the number
+            of images, acquisition date/time boundaries and the most common
+            value of each metadata field.
+
+        """
+        images = self.images()
+        grouped = images.groupby('SeriesInstanceUID', observed=True, sort=False)
+        summary = pandas.DataFrame({
+            'Images': grouped.size(),
+            'MinAcquisitionDateTime': grouped['AcquisitionDateTime'].min(),
+            'MaxAcquisitionDateTime': grouped['AcquisitionDateTime'].max(),
+        })
+        for name in self._SUMMARY:
+            counts = images.groupby(['SeriesInstanceUID', name],
+                                    observed=True, sort=False).size()
+            most_common = counts.groupby(level=0, observed=True).idxmax()
+            summary[name] = pandas.Series([x[1] for x in most_common],
+                                          index=most_common.index)
+            summary[name + 'Count'] = grouped[name].nunique()
+        return summary
+
+
+def tabulate_image_data(path, force=False):
+    """Find DICOM files and store their metadata in a columnar table.
+
+    This is an alternative to :func:`report_image_data` for very large scans.
+    Series are summarized from the table using *groupby* operations.
+
+    Parameters
+    ----------
+    path : unicode
+        Directory to read DICOM files from.
+    force : bool
+        Try reading nonstandard DICOM files, typically without "PART 10" headers.
+
+    Returns
+    -------
+    ImageDataTable
+        Call its `series()` method for a report of DICOM series.
+
+    """
+    table = ImageDataTable()
+
+    for (metadata, relpath) in walk_image_data(path, force=force):
+        table.append(metadata, relpath)
+
+    return table
@@ -31,4 +31,16 @@
 
 from .imaging import check_zip_name
 from .imaging import check_zip_content
+from .imaging import check_zip_integrity
+from .imaging import check_zip_stream
 from .imaging import ZipTree
+from .imaging import classify_series_description
+from .imaging import BLOCKING
+from .imaging import WARNING
+from .quarantine import CheckResult
+from .quarantine import check_zip_files
+from .quarantine import watch_zip_files
+from .quarantine import tabulate_check_results
+from .quarantine import write_check_results
+from .quarantine import zip_fingerprints
+from .quarantine import FingerprintIndex
@@ -29,9 +29,17 @@
 # knowledge of the CeCILL license and that you accept its terms.
 
 import os
-import tempfile
-import shutil
 import unicodedata
+import zlib
+import hashlib
+import struct
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+from io import BytesIO
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
 from zipfile import ZipFile
 try:
     from zipfile import BadZipFile
@@ -41,11 +49,17 @@ except ImportError:
 from ..core import PSC2_FROM_PSC1
 from ..core import Error
 from ..dicom_utils import read_metadata
+from ..image_data import _sample_indices
+from .zip_utils import find_central_directory
+from .zip_utils import read_central_directory
+from .zip_utils import iter_local_files
+from .zip_utils import FollowedFile
 
 import logging
 logger = logging.getLogger(__name__)
 
-__all__ = ['check_zip_name', 'check_zip_content', 'ZipTree']
+__all__ = ['check_zip_name', 'check_zip_content', 'check_zip_integrity',
+           'check_zip_stream', 'ZipTree', 'classify_series_description']
 
 
 def _check_psc1(subject_id, suffix=None, psc1=None):
@@ -55,24 +69,24 @@ def _check_psc1(subject_id, suffix=None, psc1=None):
         if subject_id.endswith(suffix):
             subject_id = subject_id[:-len(suffix)]
         elif len(subject_id) <= 12 or subject_id.isdigit():
-            yield 'PSC1 code "{0}" should end with suffix "{1}"'.format(subject_id, suffix)
+            yield 'PSC1_SUFFIX_MISSING', 'PSC1 code "{0}" should end with suffix "{1}"'.format(subject_id, suffix)
     if subject_id.isdigit():
         if len(subject_id) != 12:
-            yield 'PSC1 code "{0}" contains {1} digits instead of 12'.format(subject_id, len(subject_id))
+            yield 'PSC1_DIGITS', 'PSC1 code "{0}" contains {1} digits instead of 12'.format(subject_id, len(subject_id))
     elif len(subject_id) > 12 and subject_id[:12].isdigit() and not subject_id[12].isdigit():
-        yield 'PSC1 code "{0}" ends with unexpected suffix "{1}"'.format(subject_id, subject_id[12:])
+        yield 'PSC1_SUFFIX_UNEXPECTED', 'PSC1 code "{0}" ends with unexpected suffix "{1}"'.format(subject_id, subject_id[12:])
         subject_id = subject_id[:12]
     if not subject_id.isdigit():
-        yield 'PSC1 code "{0}" should contain 12 digits'.format(subject_id)
+        yield 'PSC1_NOT_DIGITS', 'PSC1 code "{0}" should contain 12 digits'.format(subject_id)
     elif len(subject_id) != 12:
-        yield 'PSC1 code "{0}" contains {1} characters instead of 12'.format(subject_id, len(subject_id))
+        yield 'PSC1_LENGTH', 'PSC1 code "{0}" contains {1} characters instead of 12'.format(subject_id, len(subject_id))
     elif subject_id not in PSC2_FROM_PSC1:
-        yield 'PSC1 code "{0}" is not valid'.format(subject_id)
+        yield 'PSC1_UNKNOWN', 'PSC1 code "{0}" is not valid'.format(subject_id)
     elif psc1:
         if suffix and psc1.endswith(suffix):
             psc1 = psc1[:-len(suffix)]
         if subject_id != psc1:
-            yield 'PSC1 code "{0}" was expected to be "{1}"'.format(subject_id, psc1)
+            yield 'PSC1_UNEXPECTED', 'PSC1 code "{0}" was expected to be "{1}"'.format(subject_id, psc1)
 
 
 def check_zip_name(path, timepoint=None, psc1=None):
@@ -101,80 +115,204 @@ def check_zip_name(path, timepoint=None, psc1=None):
             suffix = None
         else:
             suffix = timepoint
-        error_list = [Error(basename, 'Incorrect ZIP file name: ' + message)
-                      for message in _check_psc1(subject_id, suffix, psc1)]
+        error_list = [Error(basename, 'Incorrect ZIP file name: ' + message,
+                            code='ZIP_NAME_' + code)
+                      for code, message in _check_psc1(subject_id, suffix, psc1)]
+        _classify(error_list)
         return subject_id, error_list
     else:
-        return None, [Error(basename, 'Not a valid ZIP file name')]
+        return None, [Error(basename, 'Not a valid ZIP file name', code='ZIP_NAME_INVALID',
+                            severity=BLOCKING)]
 
 
-class ZipTree:
-    """Node of a tree structure to represent ZipFile contents.
+try:
+    array('Q')
+except ValueError:  # Python 2
+    _UINT64 = 'L'
+else:
+    _UINT64 = 'Q'
+
+
+ZipEntry = namedtuple('ZipEntry', ['filename', 'file_size', 'CRC', 'header_offset'])
+
+
+class _ZipIndex(object):
+    """Flat index of ZIP file members.
+
+    Member names are sorted, so that members under a directory make up
+    a contiguous range. Sizes, CRCs and offsets of local headers are
+    stored in arrays parallel to names.
+
+    """
+    __slots__ = ('names', 'sizes', 'crcs', 'offsets')
+
+    def __init__(self, entries):
+        entries = sorted(entries)
+        self.names = [x[0] for x in entries]
+        self.sizes = array(_UINT64, (x[1] for x in entries))
+        self.crcs = array('L', (x[2] for x in entries))
+        self.offsets = array(_UINT64, (x[3] for x in entries))
+        for k in range(1, len(self.names)):
+            if self.names[k] == self.names[k - 1] and not self.names[k].endswith('/'):
+                raise BadZipFile('duplicate file entry in zipfile')
+
+    @staticmethod
+    def from_zipfile(zip_file):
+        return _ZipIndex((zipinfo.filename, zipinfo.file_size,
+                          zipinfo.CRC, zipinfo.header_offset)
+                         for zipinfo in zip_file.infolist())
+
+    def entry(self, k):
+        return ZipEntry(self.names[k], self.sizes[k],
+                        self.crcs[k], self.offsets[k])
+
+    def end(self, prefix, lo, hi):
+        """End of the range of members starting with a directory prefix."""
+        # '0' is the character following '/'
+        return bisect_left(self.names, prefix[:-1] + '0', lo, hi)
+
+
+class ZipTree(object):
+    """View of a directory of a ZipFile.
+
+    Members of the ZIP file are stored in a flat index shared by all views.
+    A view is a range of this index, the members under its directory.
 
     Attributes
     ----------
+    filename : str
+        Name of the directory, ending with '/', empty at the root.
     directories : dict
-        Dictionnary of subdirectories.
-    files : str
-        Dictionnary of files under this node.
+        Dictionnary of subdirectories, computed on demand.
+    files : dict
+        Dictionnary of files under this node, as ZipEntry named tuples,
+        computed on demand.
 
     """
+    __slots__ = ('filename', '_index', '_lo', '_hi')
 
-    def __init__(self, filename=''):
+    def __init__(self, filename='', index=None, lo=0, hi=None):
         self.filename = filename
-        self.directories = {}
-        self.files = {}
+        self._index = index if index is not None else _ZipIndex(())
+        self._lo = lo
+        self._hi = len(self._index.names) if hi is None else hi
 
     @staticmethod
     def create(path):
-        ziptree = ZipTree()
-        with ZipFile(path, 'r') as z:
-            for zipinfo in z.infolist():
-                ziptree._add(zipinfo)  # pylint: disable=W0212
-        return ziptree
-
-    def _add(self, zipinfo):
-        d = self
-
-        if zipinfo.filename.endswith('/'):  # directory
-            parts = zipinfo.filename.rstrip('/').split('/')
-            dirname = ''
-            for part in parts:
-                dirname += part + '/'
-                d = d.directories.setdefault(part, ZipTree(dirname))
-        else:  # file
-            parts = zipinfo.filename.split('/')
-            basename = parts.pop()
-            dirname = ''
-            for part in parts:
-                dirname += part + '/'
-                d = d.directories.setdefault(part, ZipTree(dirname))
-            if basename not in d.files:
-                d.files[basename] = zipinfo
+        try:
+            entries = read_central_directory(path)
+        except BadZipFile as e:
+            # let zipfile handle unusual or corrupt ZIP files
+            logger.debug('fall back to zipfile (%s): %s', str(e), path)
+            with ZipFile(path, 'r') as z:
+                return ZipTree.from_zipfile(z)
+        return ZipTree(index=_ZipIndex(entries))
+
+    @staticmethod
+    def from_zipfile(zip_file):
+        return ZipTree(index=_ZipIndex.from_zipfile(zip_file))
+
+    def _children(self):
+        """Scan immediate children of the directory.
+
+        Yields
+        ------
+        tuple
+            Either ('d', name, ZipTree) or ('f', name, k) where k
+            is the position of the file in the index.
+
+        """
+        names = self._index.names
+        start = len(self.filename)
+        k = self._lo
+        while k < self._hi:
+            name = names[k]
+            if name == self.filename:  # explicit directory entry
+                k += 1
+                continue
+            slash = name.find('/', start)
+            if slash < 0:
+                yield 'f', name[start:], k
+                k += 1
             else:
-                raise BadZipFile('duplicate file entry in zipfile')
+                prefix = name[:slash + 1]
+                end = self._index.end(prefix, k, self._hi)
+                yield 'd', name[start:slash], ZipTree(prefix, self._index, k, end)
+                k = end
+
+    @property
+    def directories(self):
+        return dict((name, x) for kind, name, x in self._children() if kind == 'd')
+
+    @property
+    def files(self):
+        return dict((name, self._index.entry(x))
+                    for kind, name, x in self._children() if kind == 'f')
+
+    def entries(self):
+        """Scan files under this directory, recursively.
+
+        Yields
+        ------
+        tuple
+            Pairs (filename, file_size).
+
+        """
+        index = self._index
+        for k in range(self._lo, self._hi):
+            name = index.names[k]
+            if not name.endswith('/'):
+                yield name, index.sizes[k]
+
+    def fingerprint(self):
+        """Fingerprint the content of this directory without decompressing it.
+
+        The fingerprint is a hash of the sorted list of sizes and CRCs of
+        files under this directory. It does not depend on file names, so
+        that identical data uploaded under different names can be found.
+
+        Returns
+        -------
+        str
+            Hexadecimal digest, None if there are no files.
+
+        """
+        index = self._index
+        members = sorted((index.sizes[k], index.crcs[k])
+                         for k in range(self._lo, self._hi)
+                         if not index.names[k].endswith('/'))
+        if not members:
+            return None
+        digest = hashlib.sha1()
+        for size, crc in members:
+            digest.update(struct.pack('<QL', size, crc))
+        return digest.hexdigest()
 
     def pprint(self, indent=''):
         self._print_children(indent)
 
     def _print_children(self, indent=''):
-        directories = list(self.directories.items())
+        directories = []
+        files = []
+        for kind, name, x in self._children():
+            if kind == 'd':
+                directories.append((name, x))
+            else:
+                files.append(name)
         if directories:
             last_directory = directories.pop()
             for d, ziptree in directories:
                 ziptree._print(d, indent, False)  # pylint: disable=W0212
         else:
             last_directory = None
-        files = list(self.files.items())
         if files:
             if last_directory:
                 d, ziptree = last_directory
                 ziptree._print(d, indent, False)  # pylint: disable=W0212
             last_file = files.pop()
-            for f, dummy_zipinfo in files:
+            for f in files:
                 print(indent + '├── ' + f)
-            f, dummy_zipinfo = last_file
-            print(indent + '└── ' + f)
+            print(indent + '└── ' + last_file)
         elif last_directory:
             d, ziptree = last_directory
             ziptree._print(d, indent)  # pylint: disable=W0212
@@ -189,22 +327,6 @@ class ZipTree:
         self._print_children(indent)
 
 
-class TemporaryDirectory(object):
-    """Backport from Python 3.
-    """
-    def __init__(self, suffix='', prefix=tempfile.gettempprefix(), dir=None):
-        self.pathname = tempfile.mkdtemp(suffix, prefix, dir)
-
-    def __repr__(self):
-        return '<{} {!r}>'.format(self.__class__.__name__, self.name)
-
-    def __enter__(self):
-        return self.pathname
-
-    def __exit__(self, exc, value, tb):
-        shutil.rmtree(self.pathname)
-
-
 def _files(ziptree):
     """List files in a ZipTree.
 
@@ -217,15 +339,12 @@ def _files(ziptree):
     f: str
 
     """
-    for f in ziptree.files:
-        yield ziptree.filename + f
-    for ziptree in ziptree.directories.values():
-        for f in _files(ziptree):
-            yield f
+    for f, dummy_size in ziptree.entries():
+        yield f
 
 
 def _check_empty_files(ziptree):
-    """Recursively check for empty files in a ZipTree.
+    """Check for empty files in a ZipTree.
 
     Parameters
     ----------
@@ -236,12 +355,9 @@ def _check_empty_files(ziptree):
     error: Error
 
     """
-    for zipinfo in ziptree.files.values():
-        if zipinfo.file_size == 0:
-            yield Error(zipinfo.filename, 'File is empty')
-    for ziptree in ziptree.directories.values():
-        for error in _check_empty_files(ziptree):
-            yield error
+    for f, size in ziptree.entries():
+        if size == 0:
+            yield Error(f, 'File is empty', code='FILE_EMPTY')
 
 
 _SERIES_DESCRIPTION = {
@@ -300,19 +416,89 @@ _SERIES_DESCRIPTION = {
 }
 
 
-def _match_series_description(sequence, series_description, center=None):
-    _SHORT_SERIES_DESCRIPTION = {}
+def _normalize_series_description(series_description):
+    """Normalize whitespace and case, and strip any "_2" suffix.
+
+    Parameters
+    ----------
+    series_description : str
+
+    Returns
+    -------
+    str
+
+    """
+    normalized = ' '.join(series_description.split()).lower()
+    if normalized.endswith('_2'):
+        normalized = normalized[:-len('_2')].rstrip()
+    return normalized
+
+
+def _index_series_description(series_descriptions):
+    """Build reverse indexes from normalized series descriptions.
+
+    Parameters
+    ----------
+    series_descriptions : dict
+        Expected series descriptions of each sequence of each centre.
+
+    Returns
+    -------
+    tuple
+        Pair of dictionaries indexed by normalized series descriptions.
+        Values of the first dictionary are sets of (centre, sequence)
+        pairs, values of the second one are sets of sequences.
+
+    """
+    centers = {}
+    sequences = {}
+    for center, series in series_descriptions.items():
+        for sequence, descriptions in series.items():
+            for description in descriptions:
+                normalized = _normalize_series_description(description)
+                centers.setdefault(normalized, set()).add((center, sequence))
+                sequences.setdefault(normalized, set()).add(sequence)
+    return centers, sequences
 
+
+_CENTER_SEQUENCES_FROM_DESCRIPTION, _SEQUENCES_FROM_DESCRIPTION = \
+    _index_series_description(_SERIES_DESCRIPTION)
+
+_SEQUENCES = set(sequence for series in _SERIES_DESCRIPTION.values()
+                 for sequence in series)
+
+
+def classify_series_description(series_description, center=None):
+    """Find the MRI sequences a series description may belong to.
+
+    Parameters
+    ----------
+    series_description : str
+        Series Description read from DICOM files.
+    center : str, optional
+        Restrict the search to sequences of this acquisition centre.
+
+    Returns
+    -------
+    set
+        Matching sequences, empty if the series description is unknown.
+
+    """
+    normalized = _normalize_series_description(series_description)
     if center:
-        if center in _SHORT_SERIES_DESCRIPTION:
-            series = _SHORT_SERIES_DESCRIPTION[center]
-            if sequence in series and series_description in series[sequence]:
-                return True
+        return set(sequence for c, sequence
+                   in _CENTER_SEQUENCES_FROM_DESCRIPTION.get(normalized, ())
+                   if c == center)
     else:
-        for series in _SERIES_DESCRIPTION.values():
-            if sequence in series and series_description in series[sequence]:
-                return True
-    return False
+        return set(_SEQUENCES_FROM_DESCRIPTION.get(normalized, ()))
+
+
+def _match_series_description(sequence, series_description, center=None):
+    normalized = _normalize_series_description(series_description)
+    if center:
+        return (center, sequence) in _CENTER_SEQUENCES_FROM_DESCRIPTION.get(normalized, ())
+    else:
+        return sequence in _SEQUENCES_FROM_DESCRIPTION.get(normalized, ())
 
 
 def _filter_non_printable(s):
@@ -344,13 +530,94 @@ def _filter_non_printable(s):
         return ''.join(translate(c) for c in s)
 
 
-def _check_sequence_content(path, ziptree, sequence, psc1, date):
+def _check_dicom_metadata(f, metadata, sequence, psc1, date):
+    """Check DICOM tags of a file from a ZIP subfolder.
+
+    The Series Description is not checked if the sequence is None.
+
+    Returns
+    -------
+    list
+        Errors found in DICOM tags.
+
+    """
+    error_list = []
+    series_description = metadata['SeriesDescription']
+    if sequence is not None and not _match_series_description(sequence, series_description):
+        error_list.append(Error(f, 'Unexpected Series Description: {0}'
+                               .format(series_description),
+                                code='SERIES_DESCRIPTION_UNEXPECTED'))
+    if 'PatientID' in metadata:
+        patient_id = metadata['PatientID']
+        if not patient_id:
+            error_list.append(Error(f, 'Empty PSC1 code', code='PSC1_EMPTY'))
+        elif patient_id != psc1:
+            patient_id = _filter_non_printable(patient_id)
+            error_list.append(Error(f, 'Inconsistent PSC1 code: {0}'
+                                   .format(patient_id), code='PSC1_INCONSISTENT'))
+    else:
+        error_list.append(Error(f, 'Missing PSC1 code', code='PSC1_MISSING'))
+    if 'AcquisitionDate' in metadata:
+        if date:
+            acquisition_date = metadata['AcquisitionDate']
+            if acquisition_date != date:
+                error_list.append(Error(f, 'Inconsistent acquisition date: {0}'
+                                       .format(acquisition_date), code='DATE_INCONSISTENT'))
+    else:
+        error_list.append(Error(f, 'Missing acquisition date', code='DATE_MISSING'))
+    return error_list
+
+
+_CONSISTENT_TAGS = (
+    ('SeriesInstanceUID', 'Series Instance UID', 'SERIES_UID_INCONSISTENT'),
+    ('PatientID', 'PSC1 code', 'PSC1_INCONSISTENT'),
+    ('AcquisitionDate', 'acquisition date', 'DATE_INCONSISTENT'),
+)
+
+
+def _check_sample_consistency(sampled):
+    """Check DICOM tags agree across files sampled from a ZIP subfolder.
+
+    Parameters
+    ----------
+    sampled : list
+        Pairs (f, metadata) of sampled files.
+
+    Returns
+    -------
+    list
+        An error for each DICOM tag that differs across sampled files.
+
+    """
+    error_list = []
+    reference = sampled[0][1]
+    for tag, label, code in _CONSISTENT_TAGS:
+        for f, metadata in sampled[1:]:
+            value = metadata.get(tag)
+            if value != reference.get(tag):
+                error_list.append(Error(f, 'Inconsistent {0} within folder: {1}'
+                                       .format(label, _filter_non_printable(str(value))),
+                                        code=code))
+                break
+    return error_list
+
+
+def _check_sequence_content(zip_file, ziptree, sequence, psc1, date, sampler=None):
     """Rapid sanity check of a ZIP subfolder containing an MRI sequence.
 
+    By default, candidate DICOM files are read into memory from the open
+    ZIP file, smallest files first, until a DICOM file can be read. Files
+    that are not DICOM files, such as Thumbs.db, are skipped. The folder is
+    reported as invalid only if none of its files is a DICOM file.
+
+    If a sampler is provided, the first, last and evenly spaced files are
+    read concurrently instead, and DICOM tags identifying the series, the
+    subject and the date of acquisition must agree across sampled files.
+
     Parameters
     ----------
-    path : str
-        Path name of the ZIP file.
+    zip_file : zipfile.ZipFile
+        Open ZIP file.
     ziptree : ZipTree
         Tree under the specific sequence folder.
     sequence : str
@@ -359,6 +626,8 @@ def _check_sequence_content(path, ziptree, sequence, psc1, date):
         Expected 12-digit PSC1 code.
     date : datetime.date
         Expected date of acquisition.
+    sampler : _SampleReader, optional
+        Choose and read multiple files within a budget.
 
     Returns
     -------
@@ -374,51 +643,310 @@ def _check_sequence_content(path, ziptree, sequence, psc1, date):
     # check zip tree is not empty and does not contain empty files
     files = list(_files(ziptree))
     if len(files) < 1:
-        error_list.append(Error(ziptree.filename, 'Folder is empty'))
-    else:
+        error_list.append(Error(ziptree.filename, 'Folder is empty', code='FOLDER_EMPTY'))
+    elif sampler is None:
         error_list.extend(_check_empty_files(ziptree))
 
         # choose a file from zip tree and check its DICOM tags
-        with TemporaryDirectory('cveda') as tempdir:
-            for f in files:
-                with ZipFile(path, 'r') as z:
-                    dicom_file = z.extract(f, tempdir)
-                    try:
-                        metadata = read_metadata(dicom_file, force=True)
-                    except IOError:
-                        continue
-                    except AttributeError:
-                        error_list.append(Error(f, 'This is not a valid DICOM file'))
-                        break
-                    else:
-                        series_description = metadata['SeriesDescription']
-                        if not _match_series_description(sequence, series_description):
-                            error_list.append(Error(f, 'Unexpected Series Description: {0}'
-                                                   .format(series_description)))
-                        if 'PatientID' in metadata:
-                            patient_id = metadata['PatientID']
-                            if not patient_id:
-                                error_list.append(Error(f, 'Empty PSC1 code'))
-                            elif patient_id != psc1:
-                                patient_id = _filter_non_printable(patient_id)
-                                error_list.append(Error(f, 'Inconsistent PSC1 code: {0}'
-                                                       .format(patient_id)))
-                        else:
-                            error_list.append(Error(f, 'Missing PSC1 code'))
-                        if 'AcquisitionDate' in metadata:
-                            if date:
-                                acquisition_date = metadata['AcquisitionDate']
-                                if acquisition_date != date:
-                                    error_list.append(Error(f, 'Inconsistent acquisition date: {0}'
-                                                           .format(acquisition_date)))
-                        else:
-                            error_list.append(Error(f, 'Missing acquisition date'))
-                        break
+        invalid = None
+        for f, size in sorted(ziptree.entries(), key=lambda x: x[1]):
+            if size == 0:
+                continue  # already reported as empty
+            try:
+                dicom_file = BytesIO(zip_file.read(f))
+                metadata = read_metadata(dicom_file, force=True)
+            except (IOError, BadZipFile, EOFError, zlib.error):
+                continue
+            except (NotImplementedError, RuntimeError) as e:
+                # unsupported compression method or encrypted member
+                error_list.append(Error(f, 'Cannot read file: {0}'.format(e),
+                                        code='MEMBER_UNSUPPORTED'))
+                break
+            except AttributeError:
+                invalid = invalid or f
+                continue
+            else:
+                error_list.extend(_check_dicom_metadata(f, metadata, sequence,
+                                                        psc1, date))
+                break
+        else:
+            if invalid:
+                error_list.append(Error(invalid, 'This is not a valid DICOM file',
+                                        code='DICOM_INVALID'))
+    else:
+        error_list.extend(_check_empty_files(ziptree))
+
+        # sample files from zip tree and check their DICOM tags
+        entries = sorted((f, size) for f, size in ziptree.entries() if size)
+        sampled = []
+        invalid = None
+        for f, data in sampler.read(sampler.choose(entries)):
+            if data is None:
+                continue
+            if isinstance(data, Exception):
+                error_list.append(Error(f, 'Cannot read file: {0}'.format(data),
+                                        code='MEMBER_UNSUPPORTED'))
+                continue
+            try:
+                metadata = read_metadata(BytesIO(data), force=True)
+            except IOError:
+                continue
+            except AttributeError:
+                invalid = invalid or f
+            else:
+                sampled.append((f, metadata))
+        if invalid and not sampled:
+            error_list.append(Error(invalid, 'This is not a valid DICOM file',
+                                    code='DICOM_INVALID'))
+        if sampled:
+            f, metadata = sampled[0]
+            error_list.extend(_check_dicom_metadata(f, metadata, sequence,
+                                                    psc1, date))
+            error_list.extend(_check_sample_consistency(sampled))
 
     return subject_ids, error_list
 
 
-def check_zip_content(path, timepoint=None, psc1=None, date=None, expected=None):
+class _ThreadLocalZipFile(object):
+    """Open a ZipFile handle per thread.
+
+    Decompression with zlib releases the GIL, so that threads with
+    their own handle can decompress members of a ZIP file in parallel.
+
+    """
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._handles = []
+
+    def get(self):
+        zip_file = getattr(self._local, 'zip_file', None)
+        if zip_file is None:
+            zip_file = ZipFile(self._path, 'r')
+            self._local.zip_file = zip_file
+            with self._lock:
+                self._handles.append(zip_file)
+        return zip_file
+
+    def close(self):
+        with self._lock:
+            for zip_file in self._handles:
+                zip_file.close()
+            self._handles = []
+
+
+_CHUNK_SIZE = 1 << 20
+
+
+class _SampleReader(object):
+    """Choose and read samples of ZIP file members within a budget.
+
+    Samples are the first, last and evenly spaced members of a folder.
+    The budget, in number of files and bytes, is shared by all folders
+    of the ZIP file, but at least one file is sampled per folder. Samples
+    are read concurrently into memory by a pool of threads.
+
+    """
+    def __init__(self, path, samples, files=None, size=None, threads=None):
+        self.samples = samples
+        self._files = files
+        self._size = size
+        self._zip_files = _ThreadLocalZipFile(path)
+        self._pool = ThreadPool(threads)
+
+    def choose(self, entries):
+        """Choose samples among (name, size) pairs sorted by name.
+
+        The budget is spent on the first and last members before evenly
+        spaced members. Samples are returned sorted by name.
+
+        """
+        indices = _sample_indices(len(entries), self.samples)
+        if len(indices) > 1:
+            indices = [indices[0], indices[-1]] + indices[1:-1]
+        chosen = []
+        for k in indices:
+            dummy_f, size = entries[k]
+            if chosen and ((self._files is not None and self._files < 1) or
+                           (self._size is not None and self._size < size)):
+                break
+            if self._files is not None:
+                self._files -= 1
+            if self._size is not None:
+                self._size -= size
+            chosen.append(k)
+        return [entries[k][0] for k in sorted(chosen)]
+
+    def _read(self, name):
+        try:
+            return self._zip_files.get().read(name)
+        except (IOError, BadZipFile, EOFError, zlib.error):
+            return None
+        except (NotImplementedError, RuntimeError) as e:
+            return e  # unsupported compression method or encrypted member
+
+    def read(self, names):
+        """Read members concurrently, return (name, data) pairs.
+
+        Data is None if a member is corrupt, or the exception raised if
+        it cannot be read at all.
+
+        """
+        return zip(names, self._pool.map(self._read, names))
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+        self._zip_files.close()
+
+
+def _verify_member(zip_files, name):
+    """Decompress a ZIP file member and verify its CRC.
+
+    Returns
+    -------
+    tuple
+        Pair (size, message) where size is the number of decompressed bytes
+        and message is None unless the member is corrupt.
+
+    """
+    size = 0
+    try:
+        with zip_files.get().open(name) as member:
+            while True:
+                chunk = member.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+    except (BadZipFile, EOFError, zlib.error, NotImplementedError,
+            RuntimeError) as e:
+        return size, str(e)
+    return size, None
+
+
+def check_zip_integrity(path, threads=None):
+    """Decompress all members of a ZIP file and verify their CRC.
+
+    Members are decompressed in parallel by a pool of threads, each
+    thread with its own ZipFile handle.
+
+    Parameters
+    ----------
+    path : str
+        Path to the ZIP file.
+    threads : int, optional
+        Number of threads, by default the number of CPUs.
+
+    Returns
+    -------
+    result: tuple
+        The tuple (throughput, errors) where throughput is expressed in MB/s
+        of decompressed data and errors is an empty list if all members
+        can be decompressed and a list of errors otherwise.
+
+    """
+    basename = os.path.basename(path)
+
+    try:
+        with ZipFile(path, 'r') as zip_file:
+            members = [zipinfo.filename for zipinfo in
+                       sorted(zip_file.infolist(), key=lambda x: x.file_size,
+                              reverse=True)
+                       if not zipinfo.filename.endswith('/')]
+    except BadZipFile as e:
+        return 0.0, [Error(basename, 'Cannot unzip: "{0}"'.format(e), code='ZIP_CORRUPT')]
+
+    error_list = []
+    total = 0
+    start = time.time()
+
+    zip_files = _ThreadLocalZipFile(path)
+    pool = ThreadPool(threads)
+    try:
+        results = pool.imap(lambda name: _verify_member(zip_files, name), members)
+        for name, (size, message) in zip(members, results):
+            total += size
+            if message:
+                error_list.append(Error(name, 'Corrupt file: {0}'.format(message),
+                                        code='MEMBER_CORRUPT'))
+    finally:
+        pool.terminate()
+        pool.join()
+        zip_files.close()
+
+    elapsed = time.time() - start
+    throughput = total / elapsed / 1e6 if elapsed else 0.0
+    logger.info('verified %d files, %d bytes in %.2f s (%.1f MB/s): %s',
+                len(members), total, elapsed, throughput, path)
+
+    return throughput, error_list
+
+
+BLOCKING = 'blocking'
+WARNING = 'warning'
+
+# errors that do not prevent an archive from being processed
+_WARNINGS = {
+    'FILE_EMPTY',
+    'SERIES_DESCRIPTION_UNEXPECTED',
+    'PSC1_EMPTY',
+    'PSC1_MISSING',
+    'DATE_INCONSISTENT',
+    'DATE_MISSING',
+    'FOLDER_NOT_ACQUIRED',
+}
+
+
+def _classify(error_list):
+    """Set the severity of errors from their code.
+
+    Returns
+    -------
+    bool
+        True if any of the errors is blocking.
+
+    """
+    blocking = False
+    for error in error_list:
+        if error.severity is None:
+            error.severity = WARNING if error.code in _WARNINGS else BLOCKING
+        if error.severity == BLOCKING:
+            blocking = True
+    return blocking
+
+
+def _cache_key(path, timepoint=None, psc1=None, date=None, expected=None,
+               integrity=False, samples=1, budget=None, fail_fast=False):
+    """Key identifying the result of checking the content of a ZIP file.
+
+    The key is built from the size, the modification time and a hash of
+    the central directory of the ZIP file, and from check arguments.
+
+    Returns
+    -------
+    str
+        None if the ZIP file cannot be fingerprinted.
+
+    """
+    try:
+        st = os.stat(path)
+        with open(path, 'rb') as f:
+            offset, size, dummy_count, end = find_central_directory(f)
+            f.seek(offset)
+            digest = hashlib.sha1(f.read(end - offset)).hexdigest()
+    except (IOError, OSError, BadZipFile):
+        return None
+    if expected:
+        expected = sorted(expected.items())
+    return repr((st.st_size, st.st_mtime, digest,
+                 timepoint, psc1, str(date) if date else None, expected,
+                 bool(integrity), samples, budget, bool(fail_fast)))
+
+
+def check_zip_content(path, timepoint=None, psc1=None, date=None, expected=None,
+                      cache=None, integrity=False, samples=1, budget=None,
+                      fail_fast=False):
     """Rapid sanity check of a ZIP file containing imaging data for a subject.
 
     Expected sequences and tests are described as a dict:
@@ -445,6 +973,31 @@ def check_zip_content(path, timepoint=None, psc1=None, date=None, expected=None)
         Date of acquisition.
     expected : dict, optional
         Which MRI sequences and tests to expect.
+    cache : dict-like, optional
+        Persistent mapping, such as a `shelve` object, where results are
+        stored. Results are looked up using a key built from the size,
+        modification time and central directory of the ZIP file, and
+        from the above arguments. A ZIP file found in the cache is not
+        opened.
+    integrity : bool
+        Decompress all files and verify their CRC, see
+        :func:`check_zip_integrity`.
+    samples : int
+        Number of DICOM files to sample in each sequence folder. With more
+        than one sample, check that Series Instance UID, PSC1 code and date
+        of acquisition agree across sampled files.
+    budget : tuple, optional
+        Maximal number of sampled files and bytes for the whole ZIP file,
+        either can be None. At least one file is sampled per folder.
+    fail_fast : bool
+        Run checks in increasing order of cost and return as soon as a
+        check finds a blocking error: size of the ZIP file, name of the
+        ZIP file (see :func:`check_zip_name`), central directory, folders
+        against expected sequences, and finally DICOM files. Use this
+        mode to decide quickly whether an archive is acceptable.
+
+    Each error is classified by its `severity` attribute, either
+    `BLOCKING` or `WARNING`.
 
     Returns
     -------
@@ -460,6 +1013,19 @@ def check_zip_content(path, timepoint=None, psc1=None, date=None, expected=None)
         If the file does not exist.
 
     """
+    if cache is not None:
+        key = _cache_key(path, timepoint, psc1, date, expected,
+                         integrity, samples, budget, fail_fast)
+        if key is not None:
+            if key in cache:
+                subject_ids, error_list = cache[key]
+                return list(subject_ids), list(error_list)
+            result = check_zip_content(path, timepoint, psc1, date, expected,
+                                       integrity=integrity, samples=samples,
+                                       budget=budget, fail_fast=fail_fast)
+            cache[key] = result
+            return result
+
     subject_ids = []
     error_list = []
 
@@ -467,40 +1033,188 @@ def check_zip_content(path, timepoint=None, psc1=None, date=None, expected=None)
 
     # is the file empty?
     if os.path.getsize(path) == 0:
-        error_list.append(Error(basename, 'File is empty'))
+        error_list.append(Error(basename, 'File is empty', code='ZIP_EMPTY'))
+        _classify(error_list)
         return (subject_ids, error_list)
 
-    # read the ZIP file into a tree structure
+    # does the ZIP file name match the expected PSC1 code?
+    if fail_fast:
+        dummy_subject_id, e = check_zip_name(path, timepoint, psc1)
+        error_list.extend(e)
+        if _classify(error_list):
+            return (subject_ids, error_list)
+
+    # read the central directory of the ZIP file into a tree structure
     try:
         ziptree = ZipTree.create(path)
     except BadZipFile as e:
-        error_list.append(Error(basename, 'Cannot unzip: "{0}"'.format(e)))
+        error_list.append(Error(basename, 'Cannot unzip: "{0}"'.format(e),
+                                code='ZIP_CORRUPT'))
+        _classify(error_list)
         return (subject_ids, error_list)
 
     # check tree structure
     for f, z in ziptree.files.items():
         error_list.append(Error(f, 'Unexpected file at the root of the ZIP file: {0}'
-                               .format(f)))
+                               .format(f), code='FILE_AT_ROOT'))
 
     if expected:
         for sequence, status in expected.items():
             if status != 'Missing' and sequence not in ziptree.directories:
                 error_list.append(Error(basename,
                                     'Missing folder at the root of the ZIP file: {0}'
-                                    .format(sequence)))
+                                    .format(sequence), code='FOLDER_MISSING',
+                                    sequence=sequence))
+        sequences = []
         for d, z in ziptree.directories.items():
             if d not in expected:
                 error_list.append(Error(basename,
                                     'Unexpected folder, unrelated to expected sequences: {0}'
-                                    .format(d)))
+                                    .format(d), code='FOLDER_UNEXPECTED',
+                                    sequence=d))
             elif expected[d] == 'Missing':
                 error_list.append(Error(basename,
                                     'Unexpected folder, associated to a "Missing" sequence: {0}'
-                                    .format(d)))
+                                    .format(d), code='FOLDER_NOT_ACQUIRED',
+                                    sequence=d))
             else:
-                s, e = _check_sequence_content(path, z, d, psc1, date)
-                subject_ids.extend(s)
-                error_list.extend(e)
-            error_list.extend(_check_empty_files(z))
-
+                sequences.append(d)
+        if _classify(error_list) and fail_fast:
+            return (subject_ids, error_list)
+
+        # open the ZIP file once to check DICOM files of all sequences
+        try:
+            zip_file = ZipFile(path, 'r')
+        except BadZipFile as e:
+            error_list.append(Error(basename, 'Cannot unzip: "{0}"'.format(e),
+                                    code='ZIP_CORRUPT'))
+            _classify(error_list)
+            return (subject_ids, error_list)
+
+        if samples > 1:
+            max_files, max_size = budget if budget else (None, None)
+            sampler = _SampleReader(path, samples, max_files, max_size)
+        else:
+            sampler = None
+
+        try:
+            with zip_file:
+                for d, z in ziptree.directories.items():
+                    if d in sequences:
+                        s, e = _check_sequence_content(zip_file, z, d, psc1, date,
+                                                       sampler)
+                        subject_ids.extend(s)
+                        error_list.extend(e)
+                    error_list.extend(_check_empty_files(z))
+                    if _classify(error_list) and fail_fast:
+                        return (subject_ids, error_list)
+        finally:
+            if sampler is not None:
+                sampler.close()
+
+    if integrity:
+        dummy_throughput, e = check_zip_integrity(path)
+        error_list.extend(e)
+
+    _classify(error_list)
     return subject_ids, error_list
+
+
+def check_zip_stream(stream, psc1=None, date=None, expected=None, name=None,
+                     interval=1.0, timeout=60.0):
+    """Rapid sanity check of a ZIP file while it is being uploaded.
+
+    Unlike :func:`check_zip_content`, the ZIP file is read as a stream.
+    Local file headers are parsed as they arrive, so that errors are
+    reported before the upload completes and the central directory is
+    written. Folders are checked against expected sequences as soon as
+    they appear, and DICOM tags of the first valid DICOM file of each
+    folder are checked as soon as that file has been read, whether or
+    not expected sequences are given.
+
+    Parameters
+    ----------
+    stream : str or file
+        ZIP file or stream opened in binary mode. If a path is given,
+        the file is followed as it grows, see :class:`FollowedFile`.
+    psc1 : str, optional
+        Expected 12-digit PSC1 code.
+    date : datetime.date, optional
+        Date of acquisition.
+    expected : dict, optional
+        Which MRI sequences and tests to expect.
+    name : str, optional
+        Name of the ZIP file in error messages.
+    interval : float
+        Seconds between attempts to read a growing file.
+    timeout : float
+        Stop waiting for a growing file after this number of seconds
+        without new data.
+
+    Yields
+    ------
+    Error
+        Errors as soon as they are found.
+
+    """
+    if not hasattr(stream, 'read'):
+        if name is None:
+            name = os.path.basename(stream)
+        with FollowedFile(stream, interval, timeout) as f:
+            for error in check_zip_stream(f, psc1, date, expected, name):
+                yield error
+        return
+
+    folders = {}  # folder -> has a DICOM file been checked?
+
+    def wanted(filename):
+        folder, sep, relpath = filename.partition('/')
+        return bool(relpath) and not relpath.endswith('/') and not folders.get(folder)
+
+    try:
+        for f, file_size, data in iter_local_files(stream, wanted):
+            folder, sep, relpath = f.partition('/')
+            if not sep:
+                yield Error(f, 'Unexpected file at the root of the ZIP file: {0}'
+                            .format(f), code='FILE_AT_ROOT')
+                continue
+            if folder not in folders:
+                folders[folder] = False
+                if expected:
+                    if folder not in expected:
+                        yield Error(name, 'Unexpected folder, unrelated to expected sequences: {0}'
+                                    .format(folder), code='FOLDER_UNEXPECTED',
+                                    sequence=folder)
+                    elif expected[folder] == 'Missing':
+                        yield Error(name, 'Unexpected folder, associated to a "Missing" sequence: {0}'
+                                    .format(folder), code='FOLDER_NOT_ACQUIRED',
+                                    sequence=folder)
+            if not relpath or relpath.endswith('/'):
+                continue  # directory entry
+            if file_size == 0:
+                yield Error(f, 'File is empty', code='FILE_EMPTY')
+            elif data is not None:
+                try:
+                    metadata = read_metadata(BytesIO(data), force=True)
+                except IOError:
+                    continue
+                except AttributeError:
+                    yield Error(f, 'This is not a valid DICOM file', code='DICOM_INVALID')
+                else:
+                    # cannot check the Series Description of unknown sequences
+                    sequence = folder if folder in _SEQUENCES else None
+                    for error in _check_dicom_metadata(f, metadata, sequence,
+                                                       psc1, date):
+                        yield error
+                folders[folder] = True
+    except (BadZipFile, zlib.error) as e:
+        yield Error(name, 'Cannot unzip: "{0}"'.format(e), code='ZIP_CORRUPT')
+        return
+
+    # the central directory has been reached
+    if expected:
+        for sequence, status in expected.items():
+            if status != 'Missing' and sequence not in folders:
+                yield Error(name, 'Missing folder at the root of the ZIP file: {0}'
+                            .format(sequence), code='FOLDER_MISSING',
+                            sequence=sequence)
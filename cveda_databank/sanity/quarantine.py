@@ -0,0 +1,595 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+import os
+import time
+import pickle
+import multiprocessing
+from collections import namedtuple
+try:
+    from zipfile import BadZipFile
+except ImportError:
+    from zipfile import BadZipfile as BadZipFile  # Python 2
+
+import pandas
+
+from ..core import Error
+from .imaging import check_zip_name
+from .imaging import check_zip_content
+from .imaging import _cache_key
+from .imaging import BLOCKING
+from .imaging import ZipTree
+
+import logging
+logger = logging.getLogger(__name__)
+
+__all__ = ['CheckResult', 'check_zip_files', 'watch_zip_files',
+           'tabulate_check_results', 'write_check_results',
+           'zip_fingerprints', 'FingerprintIndex']
+
+try:
+    string_types = (str, unicode)  # Python 2
+except NameError:
+    string_types = (str,)
+
+
+CheckResult = namedtuple('CheckResult', ['path', 'psc1', 'errors'])
+
+
+def _zip_paths(paths):
+    """List ZIP files from directories and ZIP files.
+
+    Parameters
+    ----------
+    paths : str or iterable
+        Directory containing ZIP files or ZIP file, or list thereof.
+
+    Returns
+    -------
+    list
+
+    """
+    if isinstance(paths, string_types):
+        paths = [paths]
+    zip_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            zip_paths.extend(sorted(os.path.join(path, f) for f in os.listdir(path)
+                                    if f.endswith('.zip')))
+        else:
+            zip_paths.append(path)
+    return zip_paths
+
+
+def _check_zip_file(task):
+    """Check name and content of a ZIP file in a worker process.
+
+    Unexpected exceptions are turned into a blocking error for the ZIP
+    file, so that a single archive cannot stop a batch of checks.
+
+    Returns
+    -------
+    tuple
+        Pair (result, content) where result is a CheckResult and content
+        is the result of check_zip_content, None if it failed.
+
+    """
+    path, timepoint, date, expected, integrity, samples, budget, fail_fast = task
+    psc1, error_list = check_zip_name(path, timepoint)
+    if fail_fast:
+        error_list = []  # the name is checked first by check_zip_content
+    try:
+        content = check_zip_content(path, timepoint, psc1, date, expected,
+                                    integrity=integrity, samples=samples,
+                                    budget=budget, fail_fast=fail_fast)
+    except (IOError, OSError) as e:
+        content = None
+        error_list.append(Error(os.path.basename(path),
+                                'Cannot read ZIP file: {0}'.format(e),
+                                code='ZIP_UNREADABLE', severity=BLOCKING))
+    except Exception as e:
+        logger.exception('%s: cannot check ZIP file', path)
+        content = None
+        error_list.append(Error(os.path.basename(path),
+                                'Cannot check ZIP file: {0}: {1}'
+                                .format(type(e).__name__, e),
+                                code='CHECK_FAILED', severity=BLOCKING))
+    else:
+        error_list.extend(content[1])
+    return CheckResult(path, psc1, error_list), content
+
+
+def check_zip_files(paths, timepoint=None, date=None, expected=None, processes=None,
+                    cache=None, integrity=False, samples=1, budget=None,
+                    fail_fast=False):
+    """Check many ZIP files in parallel on a pool of processes.
+
+    Each ZIP file is checked by :func:`check_zip_name` then
+    :func:`check_zip_content`, using the PSC1 code found in its name.
+
+    Parameters
+    ----------
+    paths : str or iterable
+        Directory containing ZIP files or ZIP file, or list thereof.
+    timepoint : str, optional
+        Time point identifier, found as a suffix in subject identifiers.
+    date : datetime.date, optional
+        Date of acquisition.
+    expected : dict, optional
+        Which MRI sequences and tests to expect.
+    processes : int, optional
+        Number of worker processes, by default the number of CPUs.
+    cache : dict-like, optional
+        Persistent mapping of results of :func:`check_zip_content`, looked
+        up and updated by the calling process only.
+    integrity : bool
+        Decompress all files and verify their CRC.
+    samples : int
+        Number of DICOM files to sample in each sequence folder.
+    budget : tuple, optional
+        Maximal number of sampled files and bytes for each ZIP file.
+    fail_fast : bool
+        Stop checking each ZIP file at the first blocking error.
+
+    Yields
+    ------
+    CheckResult
+        Named tuple (path, psc1, errors) for each ZIP file, as soon as
+        it has been checked, where errors is a list of Error objects.
+
+    """
+    tasks = []
+    keys = {}
+    for path in _zip_paths(paths):
+        if cache is not None:
+            psc1, error_list = check_zip_name(path, timepoint)
+            key = _cache_key(path, timepoint, psc1, date, expected,
+                             integrity, samples, budget, fail_fast)
+            if key is not None:
+                if key in cache:
+                    if fail_fast:
+                        error_list = []
+                    error_list.extend(cache[key][1])
+                    yield CheckResult(path, psc1, error_list)
+                    continue
+                keys[path] = key
+        tasks.append((path, timepoint, date, expected, integrity,
+                      samples, budget, fail_fast))
+    logger.info('start checking %d ZIP files', len(tasks))
+
+    if not tasks:
+        return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result, content in pool.imap_unordered(_check_zip_file, tasks):
+            if content is not None and result.path in keys:
+                cache[keys[result.path]] = content
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _stat_zip_files(path):
+    """Map ZIP files in a directory to their size and modification time."""
+    states = {}
+    for f in os.listdir(path):
+        if f.endswith('.zip'):
+            zip_path = os.path.join(path, f)
+            try:
+                st = os.stat(zip_path)
+            except OSError:
+                continue  # removed since listed
+            states[zip_path] = (st.st_size, st.st_mtime)
+    return states
+
+
+def watch_zip_files(path, interval=60, timepoint=None, date=None, expected=None,
+                    processes=None, cache=None, integrity=False, samples=1,
+                    budget=None, fail_fast=False, polls=None):
+    """Watch a directory and check ZIP files once uploads are complete.
+
+    The directory is polled at regular intervals. A ZIP file is considered
+    complete once its size and modification time have not changed between
+    two polls. Complete ZIP files are then checked by
+    :func:`check_zip_files`, and checked again whenever they change.
+
+    Since the watcher runs in a single long-lived process, modules and
+    mapping tables are loaded once and shared by all checks. Failures are
+    logged and the watcher keeps polling: archives that could not be
+    checked are checked again at the next poll.
+
+    Parameters
+    ----------
+    path : str
+        Directory where ZIP files are uploaded.
+    interval : float
+        Seconds between polls.
+    polls : int, optional
+        Stop after this number of polls, by default watch forever.
+
+    See :func:`check_zip_files` for other parameters.
+
+    Yields
+    ------
+    CheckResult
+        Named tuple (path, psc1, errors) for each complete ZIP file.
+
+    """
+    previous = {}
+    checked = {}
+    count = 0
+    while True:
+        try:
+            current = _stat_zip_files(path)
+        except OSError as e:
+            logger.error('%s: cannot list ZIP files: %s', path, e)
+            current = previous
+        stable = sorted(p for p, state in current.items()
+                        if previous.get(p) == state and checked.get(p) != state)
+        if stable:
+            logger.info('%d new or updated ZIP files', len(stable))
+            try:
+                for result in check_zip_files(stable, timepoint, date, expected,
+                                              processes, cache, integrity,
+                                              samples, budget, fail_fast):
+                    checked[result.path] = current[result.path]
+                    yield result
+            except Exception:
+                logger.exception('%s: cannot check ZIP files', path)
+        for p in set(checked) - set(current):
+            del checked[p]  # forget removed ZIP files
+        previous = current
+
+        count += 1
+        if polls is not None and count >= polls:
+            break
+        time.sleep(interval)
+
+
+REPORT_COLUMNS = ['archive', 'psc1', 'timepoint', 'sequence', 'code',
+                  'severity', 'message']
+
+
+def _error_sequence(error):
+    """Find the sequence folder an error relates to, if any."""
+    if error.sequence:
+        return error.sequence
+    if error.path and '/' in error.path:
+        return error.path.split('/', 1)[0]
+    return None
+
+
+def tabulate_check_results(results, timepoint=None):
+    """Store results of sanity checks of many ZIP files in a table.
+
+    The table has a row for each error, with columns listed in
+    `REPORT_COLUMNS`. ZIP files without errors have a single row
+    where error columns are empty, so that they can be counted.
+
+    Parameters
+    ----------
+    results : iterable
+        CheckResult objects, as yielded by :func:`check_zip_files`.
+    timepoint : str, optional
+        Time point of the ZIP files.
+
+    Returns
+    -------
+    pandas.DataFrame
+
+    """
+    rows = []
+    for result in results:
+        archive = os.path.basename(result.path)
+        if result.errors:
+            for error in result.errors:
+                rows.append((archive, result.psc1, timepoint,
+                             _error_sequence(error), error.code,
+                             error.severity, error.message))
+        else:
+            rows.append((archive, result.psc1, timepoint,
+                         None, None, None, None))
+    table = pandas.DataFrame.from_records(rows, columns=REPORT_COLUMNS)
+    for column in ('psc1', 'timepoint', 'sequence', 'code', 'severity'):
+        table[column] = table[column].astype('category')
+    return table
+
+
+def write_check_results(results, path, timepoint=None, format=None):
+    """Write results of sanity checks of many ZIP files to a table.
+
+    Parameters
+    ----------
+    results : iterable
+        CheckResult objects, as yielded by :func:`check_zip_files`.
+    path : str
+        Output file.
+    timepoint : str, optional
+        Time point of the ZIP files.
+    format : str, optional
+        One of 'csv', 'parquet' or 'feather', by default guessed from
+        the extension of the output file. Parquet and Feather require
+        `pyarrow`.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The table that has been written.
+
+    Raises
+    ------
+    ValueError
+        If the format is not supported.
+
+    """
+    if format is None:
+        format = os.path.splitext(path)[1][1:].lower() or 'csv'
+    table = tabulate_check_results(results, timepoint)
+    if format == 'csv':
+        table.to_csv(path, index=False)
+    elif format == 'parquet':
+        table.to_parquet(path, index=False)
+    elif format == 'feather':
+        table.to_feather(path)
+    else:
+        raise ValueError('unsupported format: {0}'.format(format))
+    return table
+
+
+def zip_fingerprints(path):
+    """Fingerprint a ZIP file and its top-level folders.
+
+    Fingerprints are computed from sizes and CRCs found in the central
+    directory, see :meth:`ZipTree.fingerprint`. Nothing is decompressed.
+
+    Parameters
+    ----------
+    path : str
+        Path to the ZIP file.
+
+    Returns
+    -------
+    tuple
+        Pair (fingerprint, folders) where fingerprint is the fingerprint
+        of the whole ZIP file and folders maps top-level folders to their
+        fingerprints.
+
+    Raises
+    ------
+    BadZipFile
+        If the ZIP file is corrupt.
+
+    """
+    ziptree = ZipTree.create(path)
+    folders = {}
+    for d, z in ziptree.directories.items():
+        fingerprint = z.fingerprint()
+        if fingerprint is not None:
+            folders[d] = fingerprint
+    return ziptree.fingerprint(), folders
+
+
+class FingerprintIndex(object):
+    """Index of fingerprints of ZIP files and their folders.
+
+    Use the index to find ZIP files uploaded more than once, possibly
+    under a different name, and sequence folders shared by different ZIP
+    files, possibly of different subjects. ZIP files are only read again
+    once they change, so that an index saved by :meth:`save` and loaded
+    by :meth:`load` can be updated at little cost as new files are uploaded.
+
+    """
+    _VERSION = 1
+
+    def __init__(self):
+        self._stats = {}  # path -> (size, mtime)
+        self._fingerprints = {}  # path -> (fingerprint, folders)
+        self._archives = {}  # fingerprint -> set of paths
+        self._folders = {}  # fingerprint -> set of (path, folder)
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index saved by a previous run.
+
+        Parameters
+        ----------
+        path : str
+            File where the index has been saved.
+
+        Returns
+        -------
+        FingerprintIndex
+            The saved index, or an empty index if there is no usable
+            saved index.
+
+        """
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except (IOError, OSError):
+            return cls()
+        except Exception as e:  # unpickling can fail in so many ways
+            logger.warning('discard unreadable index (%s): %s', str(e), path)
+            return cls()
+        if not isinstance(state, dict) or state.get('version') != cls._VERSION:
+            logger.info('discard obsolete index: %s', path)
+            return cls()
+        index = cls()
+        index._stats = state['stats']
+        index._fingerprints = state['fingerprints']
+        index._archives = state['archives']
+        index._folders = state['folders']
+        return index
+
+    def save(self, path):
+        """Save the index for a later run.
+
+        The file is replaced atomically, so that an interrupted run
+        leaves the previous index untouched.
+
+        Parameters
+        ----------
+        path : str
+            File where to save the index.
+
+        """
+        state = {
+            'version': self._VERSION,
+            'stats': self._stats,
+            'fingerprints': self._fingerprints,
+            'archives': self._archives,
+            'folders': self._folders,
+        }
+        temp_path = path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                pickle.dump(state, f, protocol=2)
+            os.rename(temp_path, path)
+        except (IOError, OSError) as e:
+            logger.error('cannot save index (%s): %s', str(e), path)
+
+    def remove(self, path):
+        """Forget a ZIP file."""
+        self._stats.pop(path, None)
+        if path in self._fingerprints:
+            fingerprint, folders = self._fingerprints.pop(path)
+            self._archives[fingerprint].discard(path)
+            if not self._archives[fingerprint]:
+                del self._archives[fingerprint]
+            for d, f in folders.items():
+                self._folders[f].discard((path, d))
+                if not self._folders[f]:
+                    del self._folders[f]
+
+    def add(self, path):
+        """Index a ZIP file, unless it has not changed since last indexed.
+
+        Returns
+        -------
+        bool
+            False if the ZIP file cannot be read or is empty.
+
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.remove(path)
+            return False
+        stat = (st.st_size, st.st_mtime)
+        if self._stats.get(path) == stat:
+            return path in self._fingerprints
+        self.remove(path)
+        self._stats[path] = stat
+        try:
+            fingerprint, folders = zip_fingerprints(path)
+        except (BadZipFile, IOError, OSError) as e:
+            logger.warning('%s: cannot fingerprint ZIP file: %s', path, e)
+            return False
+        if fingerprint is None:
+            return False
+        self._fingerprints[path] = (fingerprint, folders)
+        self._archives.setdefault(fingerprint, set()).add(path)
+        for d, f in folders.items():
+            self._folders.setdefault(f, set()).add((path, d))
+        return True
+
+    def update(self, paths):
+        """Index new or modified ZIP files and forget removed ZIP files.
+
+        Parameters
+        ----------
+        paths : str or iterable
+            Directory containing ZIP files or ZIP file, or list thereof.
+
+        """
+        for path in list(self._stats):
+            if not os.path.exists(path):
+                self.remove(path)
+        for path in _zip_paths(paths):
+            self.add(path)
+
+    def find(self, path):
+        """Find ZIP files and folders identical to those of a ZIP file.
+
+        Parameters
+        ----------
+        path : str
+            Path to an indexed ZIP file.
+
+        Returns
+        -------
+        tuple
+            Pair (archives, folders) where archives is a sorted list of
+            other identical ZIP files and folders maps each folder of the
+            ZIP file to a sorted list of identical (path, folder) pairs
+            in other ZIP files.
+
+        """
+        if path not in self._fingerprints:
+            return [], {}
+        fingerprint, folders = self._fingerprints[path]
+        archives = sorted(self._archives[fingerprint] - {path})
+        duplicates = {}
+        for d, f in folders.items():
+            others = sorted(x for x in self._folders[f] if x[0] != path)
+            if others:
+                duplicates[d] = others
+        return archives, duplicates
+
+    def duplicate_archives(self):
+        """List groups of identical ZIP files.
+
+        Returns
+        -------
+        list
+            Sorted lists of paths of identical ZIP files.
+
+        """
+        return sorted(sorted(paths) for paths in self._archives.values()
+                      if len(paths) > 1)
+
+    def duplicate_folders(self):
+        """List groups of identical folders found in different ZIP files.
+
+        Returns
+        -------
+        list
+            Sorted lists of (path, folder) pairs of identical folders.
+
+        """
+        return sorted(sorted(folders) for folders in self._folders.values()
+                      if len(set(path for path, d in folders)) > 1)
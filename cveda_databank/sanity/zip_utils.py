@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+import mmap
+import struct
+import zlib
+import time
+try:
+    from zipfile import BadZipFile
+except ImportError:
+    from zipfile import BadZipfile as BadZipFile  # Python 2
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# end of central directory record
+_EOCD = struct.Struct('<4s4H2LH')
+_EOCD_SIGNATURE = b'PK\x05\x06'
+_EOCD_MAX_COMMENT = 0xffff
+
+# ZIP64 end of central directory locator and record
+_ZIP64_LOCATOR = struct.Struct('<4sLQL')
+_ZIP64_LOCATOR_SIGNATURE = b'PK\x06\x07'
+_ZIP64_EOCD = struct.Struct('<4sQ2H2L4Q')
+_ZIP64_EOCD_SIGNATURE = b'PK\x06\x06'
+
+
+def find_central_directory(f):
+    """Locate the central directory of a ZIP file.
+
+    Parameters
+    ----------
+    f : file
+        ZIP file opened in binary mode, or memory-mapped ZIP file.
+
+    Returns
+    -------
+    tuple
+        The tuple (offset, size, count, end) where offset and size locate
+        the central directory, count is the number of entries and end is
+        the offset of the end of central directory records.
+
+    Raises
+    ------
+    BadZipFile
+        If the end of central directory record cannot be found or the
+        ZIP file spans multiple disks.
+
+    """
+    f.seek(0, 2)
+    file_size = f.tell()
+    tail_size = min(file_size, _EOCD.size + _EOCD_MAX_COMMENT)
+    f.seek(file_size - tail_size)
+    tail = f.read(tail_size)
+
+    # the record is followed by a comment of variable length
+    position = tail.rfind(_EOCD_SIGNATURE)
+    while position >= 0:
+        if position + _EOCD.size <= len(tail):
+            record = _EOCD.unpack_from(tail, position)
+            if position + _EOCD.size + record[7] == len(tail):
+                break
+        position = tail.rfind(_EOCD_SIGNATURE, 0, position)
+    else:
+        raise BadZipFile('File is not a zip file')
+    (dummy_signature, disk, cd_disk, disk_count, count,
+     size, offset, dummy_comment_length) = record
+    end = file_size - tail_size + position
+
+    if 0xffff in (disk, cd_disk, disk_count, count) or 0xffffffff in (size, offset):
+        # ZIP64 locator immediately precedes the end of central directory record
+        if end < _ZIP64_LOCATOR.size:
+            raise BadZipFile('Corrupt ZIP64 end of central directory locator')
+        f.seek(end - _ZIP64_LOCATOR.size)
+        locator = _ZIP64_LOCATOR.unpack(f.read(_ZIP64_LOCATOR.size))
+        if locator[0] != _ZIP64_LOCATOR_SIGNATURE:
+            raise BadZipFile('Corrupt ZIP64 end of central directory locator')
+        if locator[3] > 1:
+            raise BadZipFile('ZIP files that span multiple disks are not supported')
+        end = locator[2]
+        f.seek(end)
+        record = f.read(_ZIP64_EOCD.size)
+        if len(record) != _ZIP64_EOCD.size:
+            raise BadZipFile('Corrupt ZIP64 end of central directory record')
+        record = _ZIP64_EOCD.unpack(record)
+        if record[0] != _ZIP64_EOCD_SIGNATURE:
+            raise BadZipFile('Corrupt ZIP64 end of central directory record')
+        (dummy_signature, dummy_record_size, dummy_version, dummy_version_needed,
+         disk, cd_disk, disk_count, count, size, offset) = record
+    if disk != cd_disk or disk_count != count:
+        raise BadZipFile('ZIP files that span multiple disks are not supported')
+
+    return offset, size, count, end
+
+
+# central directory file header
+_CD_HEADER = struct.Struct('<4s6H3L5H2L')
+_CD_SIGNATURE = b'PK\x01\x02'
+
+# ZIP64 extended information extra field
+_ZIP64_EXTRA_ID = 0x0001
+_EXTRA_HEADER = struct.Struct('<2H')
+
+# general purpose flag: file name is encoded in UTF-8
+_FLAG_UTF8 = 0x800
+
+
+def _zip64_extra(extra, file_size, compressed_size, header_offset):
+    """Read 64-bit values from the ZIP64 extended information extra field."""
+    position = 0
+    while position + _EXTRA_HEADER.size <= len(extra):
+        header_id, data_size = _EXTRA_HEADER.unpack_from(extra, position)
+        position += _EXTRA_HEADER.size
+        if header_id == _ZIP64_EXTRA_ID:
+            values = []
+            for value in (file_size, compressed_size, header_offset):
+                if value == 0xffffffff:
+                    values.append(struct.unpack_from('<Q', extra, position)[0])
+                    position += 8
+                else:
+                    values.append(value)
+            return tuple(values)
+        position += data_size
+    raise BadZipFile('Corrupt ZIP64 extra field')
+
+
+def _parse_central_directory(data):
+    """Parse the central directory of a memory-mapped ZIP file.
+
+    Raises
+    ------
+    BadZipFile
+        If the ZIP file is corrupt or unusual, for example if data
+        has been prepended to the ZIP file.
+
+    """
+    offset, size, count, end = find_central_directory(data)
+    if offset + size != end:
+        raise BadZipFile('Unexpected offset of central directory')
+
+    entries = []
+    position = offset
+    for dummy_i in range(count):
+        header = _CD_HEADER.unpack_from(data, position)
+        if header[0] != _CD_SIGNATURE:
+            raise BadZipFile('Bad magic number for central directory')
+        flags = header[3]
+        crc, compressed_size, file_size = header[7:10]
+        name_length, extra_length, comment_length = header[10:13]
+        header_offset = header[16]
+        position += _CD_HEADER.size
+        filename = data[position:position + name_length]
+        position += name_length
+        if 0xffffffff in (file_size, compressed_size, header_offset):
+            extra = data[position:position + extra_length]
+            file_size, compressed_size, header_offset = _zip64_extra(
+                extra, file_size, compressed_size, header_offset)
+        position += extra_length + comment_length
+
+        # decode file names the way zipfile does
+        filename = filename.decode('utf-8' if flags & _FLAG_UTF8 else 'cp437')
+        null_byte = filename.find(chr(0))
+        if null_byte >= 0:
+            filename = filename[:null_byte]
+        entries.append((filename, file_size, crc, header_offset))
+
+    if position != end:
+        raise BadZipFile('Unexpected size of central directory')
+
+    return entries
+
+
+def read_central_directory(path):
+    """Read names, sizes, CRCs and offsets of members of a ZIP file.
+
+    This is a fast alternative to `zipfile.ZipFile.infolist`, parsing the
+    central directory of the memory-mapped ZIP file without building
+    `ZipInfo` objects.
+
+    Parameters
+    ----------
+    path : str
+        Path to the ZIP file.
+
+    Returns
+    -------
+    list
+        Tuples (filename, file_size, CRC, header_offset) for each member.
+
+    Raises
+    ------
+    BadZipFile
+        If the ZIP file is corrupt or unusual. Callers should then fall
+        back to `zipfile`.
+
+    """
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # cannot map empty files
+            raise BadZipFile('File is not a zip file')
+        try:
+            return _parse_central_directory(data)
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            raise BadZipFile('Cannot parse central directory: {0}'.format(e))
+        finally:
+            data.close()
+
+
+# local file header, data descriptor
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+_LOCAL_SIGNATURE = b'PK\x03\x04'
+_DESCRIPTOR = struct.Struct('<3L')
+_ZIP64_DESCRIPTOR = struct.Struct('<L2Q')
+_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+_END_SIGNATURES = (_CD_SIGNATURE, _EOCD_SIGNATURE, _ZIP64_EOCD_SIGNATURE)
+
+# general purpose flag: sizes and CRC are stored in a data descriptor
+_FLAG_DESCRIPTOR = 0x08
+
+_STORED = 0
+_DEFLATED = 8
+
+_STREAM_CHUNK_SIZE = 1 << 16
+
+
+class _StreamReader(object):
+    """Read a byte stream with the ability to push back data."""
+
+    def __init__(self, stream, chunk_size=_STREAM_CHUNK_SIZE):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._pending = b''
+
+    def chunk(self):
+        """Return pending data or a chunk of the stream, empty at EOF."""
+        if self._pending:
+            data, self._pending = self._pending, b''
+            return data
+        return self._stream.read(self._chunk_size)
+
+    def unread(self, data):
+        self._pending = data + self._pending
+
+    def read(self, n):
+        """Return exactly n bytes, unless EOF is reached."""
+        parts = []
+        while n > 0:
+            data = self.chunk()
+            if not data:
+                break
+            if len(data) > n:
+                self.unread(data[n:])
+                data = data[:n]
+            parts.append(data)
+            n -= len(data)
+        return b''.join(parts)
+
+    def skip(self, n):
+        while n > 0:
+            data = self.chunk()
+            if not data:
+                raise BadZipFile('Truncated file data')
+            if len(data) > n:
+                self.unread(data[n:])
+                data = data[:n]
+            n -= len(data)
+
+
+class FollowedFile(object):
+    """Read a file while it is still being written, as `tail -f` does.
+
+    Reads block until more data is appended to the file, or return an
+    empty string once the file has not grown for a while.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file.
+    interval : float
+        Seconds between attempts to read more data.
+    timeout : float
+        Consider the file complete after this number of seconds without
+        new data.
+
+    """
+
+    def __init__(self, path, interval=1.0, timeout=60.0):
+        self._file = open(path, 'rb')
+        self.interval = interval
+        self.timeout = timeout
+
+    def read(self, n=-1):
+        start = time.time()
+        while True:
+            data = self._file.read(n)
+            if data or time.time() - start >= self.timeout:
+                return data
+            time.sleep(self.interval)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _inflate(reader, keep):
+    """Decompress a deflated member of unknown size from a stream."""
+    decompressor = zlib.decompressobj(-15)
+    parts = []
+    while not decompressor.eof:
+        data = reader.chunk()
+        if not data:
+            raise BadZipFile('Truncated file data')
+        data = decompressor.decompress(data)
+        if keep:
+            parts.append(data)
+    reader.unread(decompressor.unused_data)
+    return b''.join(parts)
+
+
+def iter_local_files(stream, wanted=None, chunk_size=_STREAM_CHUNK_SIZE):
+    """Parse local file headers of a ZIP file read as a stream.
+
+    Members are reported in the order they are stored, as soon as they
+    have been read, without seeking and without waiting for the central
+    directory at the end of the ZIP file.
+
+    Parameters
+    ----------
+    stream : file
+        ZIP file or stream opened in binary mode.
+    wanted : callable, optional
+        Decompress data of members whose name satisfies this predicate.
+    chunk_size : int
+        Size of chunks read from the stream.
+
+    Yields
+    ------
+    tuple
+        The tuple (filename, file_size, data) for each member, where data
+        is the uncompressed content of wanted members and None otherwise.
+
+    Raises
+    ------
+    BadZipFile
+        If the stream is truncated or corrupt, or if a member cannot be
+        delimited without the central directory.
+
+    """
+    reader = _StreamReader(stream, chunk_size)
+    while True:
+        signature = reader.read(4)
+        if signature in _END_SIGNATURES:
+            return
+        if len(signature) < 4:
+            raise BadZipFile('Truncated ZIP file')
+        if signature != _LOCAL_SIGNATURE:
+            raise BadZipFile('Bad magic number for file header')
+        header = reader.read(_LOCAL_HEADER.size - 4)
+        if len(header) < _LOCAL_HEADER.size - 4:
+            raise BadZipFile('Truncated file header')
+        header = _LOCAL_HEADER.unpack(signature + header)
+        flags, method = header[2:4]
+        compressed_size, file_size = header[7:9]
+        name_length, extra_length = header[9:11]
+        filename = reader.read(name_length)
+        extra = reader.read(extra_length)
+        if len(filename) + len(extra) < name_length + extra_length:
+            raise BadZipFile('Truncated file header')
+        zip64 = 0xffffffff in (file_size, compressed_size)
+        if zip64:
+            file_size, compressed_size, dummy_offset = _zip64_extra(
+                extra, file_size, compressed_size, 0)
+
+        # decode file names the way zipfile does
+        filename = filename.decode('utf-8' if flags & _FLAG_UTF8 else 'cp437')
+        null_byte = filename.find(chr(0))
+        if null_byte >= 0:
+            filename = filename[:null_byte]
+        keep = wanted is not None and wanted(filename)
+
+        data = None
+        if flags & _FLAG_DESCRIPTOR:
+            # sizes follow file data, find its end by decompressing it
+            if method != _DEFLATED:
+                raise BadZipFile('Cannot delimit file data of unknown size: {0}'
+                                 .format(filename))
+            data = _inflate(reader, keep)
+            descriptor = _ZIP64_DESCRIPTOR if zip64 else _DESCRIPTOR
+            record = reader.read(4)
+            if record != _DESCRIPTOR_SIGNATURE:  # the signature is optional
+                reader.unread(record)
+            record = reader.read(descriptor.size)
+            if len(record) < descriptor.size:
+                raise BadZipFile('Truncated data descriptor')
+            dummy_crc, compressed_size, file_size = descriptor.unpack(record)
+            if not keep:
+                data = None
+        elif keep and method in (_STORED, _DEFLATED):
+            data = reader.read(compressed_size)
+            if len(data) < compressed_size:
+                raise BadZipFile('Truncated file data')
+            if method == _DEFLATED:
+                data = zlib.decompress(data, -15)
+        else:
+            reader.skip(compressed_size)
+
+        yield filename, file_size, data
@@ -30,12 +30,21 @@
 # knowledge of the CeCILL license and that you accept its terms.
 
 import os
+import errno
+import argparse
+import multiprocessing
 import zipfile
 import zlib
 import tempfile
 from datetime import datetime
 import shutil
 import subprocess
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
 from cveda_databank import PSC2_FROM_PSC1
 import json
 import logging
@@ -46,6 +55,12 @@ logging.basicConfig(level=logging.INFO)
 QUARANTINE_PATH = '/cveda/databank/RAW/QUARANTINE'
 BIDS_PATH = '/cveda/databank/processed/nifti'
 SKIP_PATH = '/cveda/databank/framework/meta_data/errors/mri_skip.json'
+SCRATCH_PATH = '/dev/shm'
+SCRATCH_BUDGET = 8 << 30  # bytes
+
+# bytes reserved in the scratch directory, shared by worker processes
+_scratch_lock = multiprocessing.Lock()
+_scratch_reserved = multiprocessing.RawValue('q', 0)
 
 
 def quarantine_filename_semantics(filename):
@@ -127,8 +142,48 @@ _BIDS_MAPPING = {
 }
 
 
-def dcm2nii(src, dst, filename, comment, bvec_bval=False):
+class _Subprocesses(object):
+    """Run subprocesses that can all be terminated at once.
+
+    Used to stop conversions still running once a conversion has failed.
+    Each subprocess runs in a session of its own, so that its children,
+    such as pigz started by dcm2niix, are terminated as well.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = set()
+        self._terminated = False
+
+    def run(self, args, **kwargs):
+        """Run a subprocess as subprocess.run() does, unless terminated."""
+        with self._lock:
+            if self._terminated:
+                return subprocess.CompletedProcess(args, -1)
+            process = subprocess.Popen(args, start_new_session=True, **kwargs)
+            self._running.add(process)
+        try:
+            stdout, stderr = process.communicate()
+        finally:
+            with self._lock:
+                self._running.discard(process)
+        return subprocess.CompletedProcess(args, process.returncode,
+                                           stdout, stderr)
+
+    def terminate(self):
+        """Terminate running subprocesses and refuse to start new ones."""
+        with self._lock:
+            self._terminated = True
+            for process in self._running:
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except OSError:
+                    pass  # already exited
+
+
+def dcm2nii(src, dst, filename, comment, bvec_bval=False, processes=None):
     status = 0
+    run = subprocess.run if processes is None else processes.run
 
     logger.info('%s: running dcm2niix: %s', src, dst)
 
@@ -138,9 +193,9 @@ def dcm2nii(src, dst, filename, comment, bvec_bval=False):
                 '-o', dst,
                 '-f', filename,
                 src]
-    completed = subprocess.run(dcm2niix,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
+    completed = run(dcm2niix,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
     if completed.returncode:
         logger.error('%s: dcm2niix failed: %s',
                      src, completed.stdout)
@@ -181,9 +236,9 @@ def dcm2nii(src, dst, filename, comment, bvec_bval=False):
                 dcm2nii = ['dcm2nii',
                            '-o', tempdir,
                            src]
-                completed = subprocess.run(dcm2nii,
-                                           stdout=subprocess.PIPE,
-                                           stderr=subprocess.PIPE)
+                completed = run(dcm2nii,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
                 if completed.returncode:
                     logger.error('%s: dcm2nii failed: %s',
                                  src, completed.stdout)
@@ -222,7 +277,313 @@ _DWI_MAPPING = {
 }
 
 
-def deidentify(timepoint, psc1, zip_path, bids_path):
+def _modality_members(zip_file, psc1, timepoint):
+    """List members of the ZIP file under each sequence folder.
+
+    Folders unrelated to a BIDS modality and files at the root of the
+    ZIP file are reported and ignored.
+
+    Returns
+    -------
+    list
+        Pairs (modality, members), largest sequences first.
+
+    """
+    modalities = {}
+    sizes = {}
+    unknown = set()
+    for zipinfo in zip_file.infolist():
+        modality, sep, dummy_name = zipinfo.filename.partition('/')
+        if not sep:
+            logger.error('%s/%s: ignore file at the root of the ZIP file: %s',
+                         psc1, timepoint, zipinfo.filename)
+        elif modality not in _BIDS_MAPPING:
+            unknown.add(modality)
+        elif not zipinfo.filename.endswith('/'):
+            modalities.setdefault(modality, []).append(zipinfo.filename)
+            sizes[modality] = sizes.get(modality, 0) + zipinfo.file_size
+    for modality in sorted(unknown):
+        logger.error('%s/%s: ignore unknown sequence folder: %s',
+                     psc1, timepoint, modality)
+    return sorted(modalities.items(), key=lambda x: sizes[x[0]], reverse=True)
+
+
+def _convert_modality(tempdir, out_ses_path, modality, psc1, psc2, timepoint,
+                      processes=None):
+    """Convert a sequence from DICOM to NIfTI and name files as in BIDS.
+
+    Returns
+    -------
+    int
+        Non-zero in case of failure.
+
+    """
+    src = os.path.join(tempdir, modality)
+    dst = os.path.join(out_ses_path, modality)
+
+    # name files as suggested in BIDS
+    if _BIDS_MAPPING[modality] == 'func':
+        filename = ('sub-' + psc2 + '_ses-' + timepoint +
+                    '_task-' + modality +
+                    '_bold')
+        bvec_bval = False
+    elif _BIDS_MAPPING[modality] == 'fmap':
+        filename = ('sub-' + psc2 + '_ses-' + timepoint)
+        bvec_bval = False
+    elif _BIDS_MAPPING[modality] == 'dwi':
+        acq = _DWI_MAPPING[modality]
+        if acq is None:
+            filename = ('sub-' + psc2 + '_ses-' + timepoint +
+                        '_dwi')
+        else:
+            filename = ('sub-' + psc2 + '_ses-' + timepoint +
+                        '_acq-' + acq + '_dwi')
+        bvec_bval = True
+    else:
+        filename = ('sub-' + psc2 + '_ses-' + timepoint +
+                    '_' + modality)
+        bvec_bval = False
+
+    os.makedirs(dst)
+    status = dcm2nii(src, dst,
+                     filename, psc2 + '/' + timepoint,
+                     bvec_bval, processes)
+    if status:
+        logger.error('%s/%s: cannot convert %s from DICOM to NIfTI: %d',
+                     psc1, timepoint, modality, status)
+        shutil.rmtree(dst)
+        return status
+
+    # rename some files for BIDS compliance
+    # remove useless extra files (such as ADC files)
+    for f in os.listdir(dst):
+        root, ext = os.path.splitext(f)
+        if ext == '.gz':
+            root, ext = os.path.splitext(root)
+            ext += '.gz'
+        if root.endswith('_c2'):  # MYSORE Philips Ingenia
+            root = root[:-len('_c2')]
+            os.rename(os.path.join(dst, f),
+                      os.path.join(dst, root + ext))
+        elif root.endswith('_dwi_ADC'):  # NIMHANS Siemens Skyra
+            logger.warning('%s/%s: DICOM conversion generates extra NIfTI file: %s',
+                           psc1, timepoint, f)
+            os.remove(os.path.join(dst, f))
+        elif root.endswith('_e2_ph'):  # Siemens
+            root = root[:-len('_e2_ph')]
+            os.rename(os.path.join(dst, f),
+                      os.path.join(dst, root + '_phasediff' + ext))
+        elif root.endswith('_e2_real'):  # Philips
+            root = root[:-len('_e2_real')]
+            os.rename(os.path.join(dst, f),
+                      os.path.join(dst, root + '_phasediff' + ext))
+        elif root.endswith('_e1a'):  # Philips
+            root = root[:-len('_e1a')]
+            os.rename(os.path.join(dst, f),
+                      os.path.join(dst, root + '_phasediff' + ext))
+        elif root.endswith('_e1'):  # Philips
+            root = root[:-len('_e1')]
+            os.rename(os.path.join(dst, f),
+                      os.path.join(dst, root + '_magnitude' + ext))
+        else:
+            root = root.replace('sub-' + psc2 + '_ses-' +
+                                timepoint + '_', '')
+            EXPECTED = {
+                'T1w',
+                'T2w',
+                'FLAIR',
+                'task-rest_bold',
+                'dwi', 'acq-ap_dwi',
+                'acq-rev_dwi',
+                'phasediff', 'magnitude',
+            }
+            if root not in EXPECTED:
+                logger.error('%s/%s: unexpected BIDS file: %s',
+                             psc1, timepoint, f)
+                status = -1
+
+    return status
+
+
+def _init_scratch(lock, reserved):
+    """Share the reservation of scratch space with a worker process."""
+    global _scratch_lock, _scratch_reserved
+    _scratch_lock = lock
+    _scratch_reserved = reserved
+
+
+def _reserve_scratch(size, scratch=None, budget=SCRATCH_BUDGET):
+    """Reserve space to unpack a ZIP file in a RAM-backed directory.
+
+    The budget is shared by all worker processes: the space reserved by
+    concurrent datasets counts against both the budget and the free space
+    of the file system.
+
+    Parameters
+    ----------
+    size : int
+        Size of the members unpacked at the same time.
+    scratch : str, optional
+        Directory on a RAM-backed file system, such as tmpfs.
+    budget : int
+        Maximal size reserved in the scratch directory by all datasets.
+
+    Returns
+    -------
+    bool
+        True if the space has been reserved, then release it with
+        :func:`_release_scratch`.
+
+    """
+    if not scratch or not os.path.isdir(scratch):
+        return False
+    with _scratch_lock:
+        reserved = _scratch_reserved.value + size
+        if reserved > budget or reserved >= shutil.disk_usage(scratch).free:
+            return False
+        _scratch_reserved.value = reserved
+    return True
+
+
+def _release_scratch(size):
+    with _scratch_lock:
+        _scratch_reserved.value -= size
+
+
+def _extract_and_convert(zip_file, modalities, out_ses_path,
+                         psc1, psc2, timepoint, conversions=1, tempdir=None):
+    """Unpack sequences one at a time and convert them concurrently.
+
+    Each sequence is converted as soon as it has been unpacked, and its
+    DICOM files are removed as soon as it has been converted. A sequence
+    is unpacked only once fewer than `conversions` sequences are pending,
+    so that at most `conversions` sequences occupy the temporary directory.
+    After the first failure, no other sequence is unpacked and conversion
+    subprocesses still running are terminated.
+
+    Returns
+    -------
+    int
+        Non-zero in case of failure.
+
+    Raises
+    ------
+    OSError
+        If there is no space left to unpack the ZIP file.
+
+    """
+    status = 0
+    processes = _Subprocesses()
+    prefix = 'cveda-mri-' + psc1
+    with tempfile.TemporaryDirectory(prefix=prefix, dir=tempdir) as tempdir, \
+            ThreadPoolExecutor(max_workers=conversions) as executor:
+        # unpack each sequence found in ZIP file into temporary directory,
+        # largest sequences first, and start converting it right away
+        futures = []
+        for modality, members in modalities:
+            pending = [f for f in futures if not f.done()]
+            if len(pending) >= conversions:
+                wait(pending, return_when=FIRST_COMPLETED)
+            if any(f.done() and (f.exception() or f.result()) for f in futures):
+                break  # a conversion has already failed
+            try:
+                for member in members:
+                    zip_file.extract(member, tempdir)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    processes.terminate()
+                    raise  # let the caller retry elsewhere
+                logger.error('%s/%s: cannot unpack ZIP file: %s',
+                             psc1, timepoint,  str(e))
+                status = -1
+                break
+            except (zipfile.BadZipFile, EOFError, zlib.error) as e:
+                logger.error('%s/%s: corrupt ZIP file: %s',
+                             psc1, timepoint,  str(e))
+                status = -1
+                break
+            future = executor.submit(_convert_modality, tempdir, out_ses_path,
+                                     modality, psc1, psc2, timepoint, processes)
+            # remove DICOM files once converted, or terminated
+            future.add_done_callback(
+                lambda f, src=os.path.join(tempdir, modality):
+                    shutil.rmtree(src, ignore_errors=True))
+            futures.append(future)
+
+        # wait for conversions
+        if status:
+            processes.terminate()
+        else:
+            for future in as_completed(futures):
+                try:
+                    status = future.result()
+                except Exception:
+                    logger.exception('%s/%s: conversion failed', psc1, timepoint)
+                    status = -1
+                if status:
+                    processes.terminate()
+                    break
+        # leaving the executor waits for terminated conversions to exit
+
+    return status
+
+
+def _unpack_and_convert(zip_file, modalities, out_ses_path, psc1, psc2,
+                        timepoint, conversions=1, scratch=None,
+                        scratch_budget=SCRATCH_BUDGET):
+    """Unpack and convert sequences, in scratch space if possible.
+
+    The space required is the size of the largest sequences unpacked at
+    the same time. If it can be reserved in the scratch directory, use
+    it, otherwise unpack on disk. If space runs out in the scratch
+    directory anyway, try again on disk.
+
+    Returns
+    -------
+    int
+        Non-zero in case of failure.
+
+    """
+    sizes = [sum(zip_file.getinfo(member).file_size for member in members)
+             for modality, members in modalities]
+    size = sum(sizes[:conversions])  # sequences are sorted largest first
+
+    if _reserve_scratch(size, scratch, scratch_budget):
+        logger.info('%s/%s: unpack up to %d bytes into %s',
+                    psc1, timepoint, size, scratch)
+        try:
+            return _extract_and_convert(zip_file, modalities, out_ses_path,
+                                        psc1, psc2, timepoint, conversions,
+                                        scratch)
+        except OSError as e:
+            if e.errno != errno.ENOSPC:
+                raise
+            logger.warning('%s/%s: out of space in %s, try again on disk',
+                           psc1, timepoint, scratch)
+            shutil.rmtree(out_ses_path, ignore_errors=True)
+        finally:
+            _release_scratch(size)
+
+    tempdir = tempfile.gettempdir()
+    if shutil.disk_usage(tempdir).free <= size:
+        logger.error('%s/%s: not enough free space to unpack %d bytes into %s',
+                     psc1, timepoint, size, tempdir)
+        return -1
+    logger.info('%s/%s: unpack up to %d bytes into %s',
+                psc1, timepoint, size, tempdir)
+    try:
+        return _extract_and_convert(zip_file, modalities, out_ses_path,
+                                    psc1, psc2, timepoint, conversions,
+                                    tempdir)
+    except OSError as e:
+        if e.errno != errno.ENOSPC:
+            raise
+        logger.error('%s/%s: out of space in %s', psc1, timepoint, tempdir)
+        return -1
+
+
+def deidentify(timepoint, psc1, zip_path, bids_path, conversions=1,
+               scratch=None, scratch_budget=SCRATCH_BUDGET):
     logger.info('%s/%s: deidentify', psc1, timepoint)
 
     psc2 = PSC2_FROM_PSC1[psc1]
@@ -240,107 +601,28 @@ def deidentify(timepoint, psc1, zip_path, bids_path):
             os.makedirs(out_ses_path)
 
     status = 0
-    prefix = 'cveda-mri-' + psc1
-    with tempfile.TemporaryDirectory(prefix=prefix) as tempdir:
-        # unpack ZIP file into temporary directory
-        with zipfile.ZipFile(zip_path) as zip_file:
-            try:
-                zip_file.extractall(tempdir)
-            except (zipfile.BadZipFile, OSError, EOFError, zlib.error) as e:
-                logger.error('%s/%s: corrupt ZIP file: %s',
-                             psc1, timepoint,  str(e))
-                return
-
-        # process each sequence found in ZIP file
-        for modality in os.listdir(tempdir):
-            src = os.path.join(tempdir, modality)
-            dst = os.path.join(out_ses_path, modality)
-
-            # name files as suggested in BIDS
-            if _BIDS_MAPPING[modality] == 'func':
-                filename = ('sub-' + psc2 + '_ses-' + timepoint +
-                            '_task-' + modality +
-                            '_bold')
-                bvec_bval = False
-            elif _BIDS_MAPPING[modality] == 'fmap':
-                filename = ('sub-' + psc2 + '_ses-' + timepoint)
-                bvec_bval = False
-            elif _BIDS_MAPPING[modality] == 'dwi':
-                acq = _DWI_MAPPING[modality]
-                if acq is None:
-                    filename = ('sub-' + psc2 + '_ses-' + timepoint +
-                                '_dwi')
-                else:
-                    filename = ('sub-' + psc2 + '_ses-' + timepoint +
-                                '_acq-' + acq + '_dwi')
-                bvec_bval = True
+    try:
+        zip_file = zipfile.ZipFile(zip_path)
+    except (zipfile.BadZipFile, OSError) as e:
+        logger.error('%s/%s: corrupt ZIP file: %s',
+                     psc1, timepoint,  str(e))
+        status = -1
+    else:
+        with zip_file:
+            modalities = _modality_members(zip_file, psc1, timepoint)
+            if modalities:
+                status = _unpack_and_convert(zip_file, modalities,
+                                             out_ses_path, psc1, psc2,
+                                             timepoint, conversions,
+                                             scratch, scratch_budget)
             else:
-                filename = ('sub-' + psc2 + '_ses-' + timepoint +
-                            '_' + modality)
-                bvec_bval = False
-
-            os.makedirs(dst)
-            status = dcm2nii(src, dst,
-                             filename, psc2 + '/' + timepoint,
-                             bvec_bval)
-            if status:
-                logger.error('%s/%s: cannot convert %s from DICOM to NIfTI: %d',
-                             psc1, timepoint, modality, status)
-                shutil.rmtree(dst)
-                break
-
-            # rename some files for BIDS compliance
-            # remove useless extra files (such as ADC files)
-            for f in os.listdir(dst):
-                root, ext = os.path.splitext(f)
-                if ext == '.gz':
-                    root, ext = os.path.splitext(root)
-                    ext += '.gz'
-                if root.endswith('_c2'):  # MYSORE Philips Ingenia
-                    root = root[:-len('_c2')]
-                    os.rename(os.path.join(dst, f),
-                              os.path.join(dst, root + ext))
-                elif root.endswith('_dwi_ADC'):  # NIMHANS Siemens Skyra
-                    logger.warning('%s/%s: DICOM conversion generates extra NIfTI file: %s',
-                                   psc1, timepoint, f)
-                    os.remove(os.path.join(dst, f))
-                elif root.endswith('_e2_ph'):  # Siemens
-                    root = root[:-len('_e2_ph')]
-                    os.rename(os.path.join(dst, f),
-                              os.path.join(dst, root + '_phasediff' + ext))
-                elif root.endswith('_e2_real'):  # Philips
-                    root = root[:-len('_e2_real')]
-                    os.rename(os.path.join(dst, f),
-                              os.path.join(dst, root + '_phasediff' + ext))
-                elif root.endswith('_e1a'):  # Philips
-                    root = root[:-len('_e1a')]
-                    os.rename(os.path.join(dst, f),
-                              os.path.join(dst, root + '_phasediff' + ext))
-                elif root.endswith('_e1'):  # Philips
-                    root = root[:-len('_e1')]
-                    os.rename(os.path.join(dst, f),
-                              os.path.join(dst, root + '_magnitude' + ext))
-                else:
-                    root = root.replace('sub-' + psc2 + '_ses-' +
-                                        timepoint + '_', '')
-                    EXPECTED = {
-                        'T1w',
-                        'T2w',
-                        'FLAIR',
-                        'task-rest_bold',
-                        'dwi', 'acq-ap_dwi',
-                        'acq-rev_dwi',
-                        'phasediff', 'magnitude',
-                    }
-                    if root not in EXPECTED:
-                        logger.error('%s/%s: unexpected BIDS file: %s',
-                                     psc1, timepoint, f)
-                        status = -1
+                logger.error('%s/%s: no sequence to convert', psc1, timepoint)
+                status = -1
 
     if status:
-        shutil.rmtree(out_ses_path)
-        if not os.listdir(out_sub_path):  # empty directory
-            os.rmdir(out_sub_path)
+        shutil.rmtree(out_ses_path, ignore_errors=True)
+        if os.path.isdir(out_sub_path) and not os.listdir(out_sub_path):
+            os.rmdir(out_sub_path)  # empty directory
     else:
         # rename some directories for BIDS compliance
         for modality in os.listdir(out_ses_path):
@@ -358,16 +640,91 @@ def deidentify(timepoint, psc1, zip_path, bids_path):
     return status
 
 
+def _deidentify_subject(task):
+    """Deidentify datasets of a subject in a worker process.
+
+    Time points of a subject are processed one after the other, because
+    they share the output directory of the subject.
+
+    Exceptions are logged and turned into a failure status, so that
+    a failed dataset does not stop the others.
+
+    """
+    psc1, timepoints, bids_path, conversions, scratch, scratch_budget = task
+    results = []
+    for timepoint, zip_path in timepoints:
+        try:
+            status = deidentify(timepoint, psc1, zip_path, bids_path,
+                                conversions, scratch, scratch_budget)
+        except Exception:
+            logger.exception('%s/%s: deidentification failed', psc1, timepoint)
+            status = -1
+        results.append((timepoint, psc1, status))
+    return results
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Deidentify and convert MRI '
+                                                 'datasets from DICOM to BIDS.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of subjects processed in parallel '
+                             '(default: 1)')
+    parser.add_argument('-c', '--conversions', type=int, default=1,
+                        help='number of sequences of a subject converted '
+                             'in parallel (default: 1)')
+    parser.add_argument('-s', '--scratch', nargs='?', const=SCRATCH_PATH,
+                        metavar='DIR',
+                        help='unpack ZIP files into this RAM-backed directory '
+                             'when they fit (default if given without DIR: '
+                             '{0}; by default unpack on disk)'.format(SCRATCH_PATH))
+    parser.add_argument('-b', '--scratch-budget', type=int, default=SCRATCH_BUDGET,
+                        metavar='BYTES',
+                        help='maximal number of bytes unpacked into the scratch '
+                             'directory by all jobs together (default: {0})'
+                             .format(SCRATCH_BUDGET))
+    args = parser.parse_args()
+
+    with open(SKIP_PATH) as skip_file:
+        skip = json.load(skip_file)
+
+    subjects = {}
     datasets = list_datasets(QUARANTINE_PATH)
-
     for timepoint, timepoint_datasets in datasets.items():
         for psc1, (zip_path, increment, timestamp) in timepoint_datasets.items():
-            with open(SKIP_PATH) as skip_file:
-                skip = json.load(skip_file)
-                if timepoint in skip and psc1 in skip[timepoint]:
-                    continue
-            deidentify(timepoint, psc1, zip_path, BIDS_PATH)
+            if timepoint in skip and psc1 in skip[timepoint]:
+                continue
+            subjects.setdefault(psc1, []).append((timepoint, zip_path))
+    tasks = [(psc1, timepoints, BIDS_PATH, args.conversions,
+              args.scratch, args.scratch_budget)
+             for psc1, timepoints in sorted(subjects.items())]
+
+    converted = 0
+    skipped = 0
+    failed = []
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs, _init_scratch,
+                                    (_scratch_lock, _scratch_reserved))
+        try:
+            results = list(pool.imap_unordered(_deidentify_subject, tasks))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = [_deidentify_subject(task) for task in tasks]
+    for subject_results in results:
+        for timepoint, psc1, status in subject_results:
+            if status is None:
+                skipped += 1  # already processed
+            elif status:
+                failed.append(psc1 + '/' + timepoint)
+            else:
+                converted += 1
+
+    logger.info('%d datasets: %d converted, %d already processed, %d failed',
+                converted + skipped + len(failed), converted, skipped, len(failed))
+    for dataset in sorted(failed):
+        logger.info('failed: %s', dataset)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Check ZIP files uploaded by acquisition centres in parallel.
+
+Results are printed for each ZIP file as soon as it has been checked,
+followed by a summary.
+
+DICOM files are only checked if expected sequences are given as a JSON
+file mapping sequence folders to their status, for example:
+
+    {"T1w": "Good", "rest": "Good", "dwi": "Missing"}
+
+In watch mode, the quarantine directory is polled and ZIP files are
+checked as soon as their upload is complete, until interrupted.
+
+"""
+
+import argparse
+import shelve
+import json
+from datetime import datetime
+from cveda_databank.sanity import check_zip_files
+from cveda_databank.sanity import watch_zip_files
+from cveda_databank.sanity import write_check_results
+from cveda_databank.sanity import FingerprintIndex
+import logging
+logging.basicConfig(level=logging.INFO)
+
+QUARANTINE_PATH = '/cveda/databank/RAW/QUARANTINE'
+
+
+def _append_report(report, result):
+    """Append the result of checking a ZIP file to a JSON lines file."""
+    record = {
+        'time': datetime.now().isoformat(),
+        'path': result.path,
+        'psc1': result.psc1,
+        'errors': [{'path': e.path, 'code': e.code, 'severity': e.severity,
+                    'message': e.message} for e in result.errors],
+    }
+    report.write(json.dumps(record) + '\n')
+    report.flush()
+
+
+def _parse_date(string):
+    """Convert an ISO 8601 date for argparse."""
+    try:
+        return datetime.strptime(string, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid date: {0}'.format(string))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('paths', nargs='*', metavar='PATH',
+                        default=[QUARANTINE_PATH],
+                        help='ZIP file or directory of ZIP files '
+                             '(default: {0})'.format(QUARANTINE_PATH))
+    parser.add_argument('-t', '--timepoint',
+                        help='time point, found as a suffix in subject identifiers')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('-e', '--expected', metavar='FILE',
+                        help='JSON file of expected sequences and their status, '
+                             'required to check DICOM files')
+    parser.add_argument('--date', type=_parse_date, metavar='YYYY-MM-DD',
+                        help='expected date of acquisition')
+    parser.add_argument('-c', '--cache', metavar='FILE',
+                        help='cache results of previous runs in this file')
+    parser.add_argument('-i', '--integrity', action='store_true',
+                        help='decompress all files and verify their CRC')
+    parser.add_argument('-s', '--samples', type=int, default=1,
+                        help='number of DICOM files to sample per sequence')
+    parser.add_argument('--max-files', type=int, default=None,
+                        help='maximal number of sampled files per ZIP file')
+    parser.add_argument('--max-bytes', type=int, default=None,
+                        help='maximal number of sampled bytes per ZIP file')
+    parser.add_argument('-x', '--fail-fast', action='store_true',
+                        help='stop checking a ZIP file at the first blocking error')
+    parser.add_argument('-d', '--duplicates', action='store_true',
+                        help='list identical ZIP files and sequence folders')
+    parser.add_argument('--index', metavar='FILE',
+                        help='keep fingerprints of ZIP files in this file '
+                             'between runs, so that unchanged ZIP files are '
+                             'not read again to find duplicates')
+    parser.add_argument('-w', '--watch', type=float, metavar='SECONDS',
+                        help='watch a directory, polling at this interval')
+    parser.add_argument('-r', '--report', metavar='FILE',
+                        help='append results to this JSON lines file')
+    parser.add_argument('--table', metavar='FILE',
+                        help='write a table of errors to this CSV, Parquet '
+                             'or Feather file, depending on its extension')
+    args = parser.parse_args()
+    if args.watch is not None and len(args.paths) != 1:
+        parser.error('watch mode requires a single directory')
+    if args.watch is not None and args.table:
+        parser.error('watch mode cannot write a table, use --report')
+    if not args.expected and (args.samples != 1 or args.max_files is not None or
+                              args.max_bytes is not None or args.date):
+        parser.error('checking DICOM files requires --expected')
+    if args.index and not args.duplicates:
+        parser.error('--index requires --duplicates')
+
+    expected = None
+    if args.expected:
+        with open(args.expected) as f:
+            expected = json.load(f)
+
+    cache = shelve.open(args.cache) if args.cache else None
+    budget = None
+    if args.max_files is not None or args.max_bytes is not None:
+        budget = (args.max_files, args.max_bytes)
+    report = open(args.report, 'a') if args.report else None
+
+    if args.watch is not None:
+        results = watch_zip_files(args.paths[0], args.watch,
+                                  timepoint=args.timepoint, date=args.date,
+                                  expected=expected,
+                                  processes=args.jobs, cache=cache,
+                                  integrity=args.integrity,
+                                  samples=args.samples, budget=budget,
+                                  fail_fast=args.fail_fast)
+    else:
+        results = check_zip_files(args.paths, timepoint=args.timepoint,
+                                  date=args.date, expected=expected,
+                                  processes=args.jobs, cache=cache,
+                                  integrity=args.integrity,
+                                  samples=args.samples, budget=budget,
+                                  fail_fast=args.fail_fast)
+
+    checked = 0
+    failed = 0
+    errors = 0
+    table = [] if args.table else None
+    try:
+        for result in results:
+            checked += 1
+            if table is not None:
+                table.append(result)
+            if result.errors:
+                failed += 1
+                errors += len(result.errors)
+                print('{0}: {1}: {2} error(s)'.format(result.path, result.psc1,
+                                                      len(result.errors)))
+                for error in result.errors:
+                    print('    {0}'.format(error))
+            else:
+                print('{0}: {1}: OK'.format(result.path, result.psc1))
+            if report is not None:
+                _append_report(report, result)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if report is not None:
+            report.close()
+        if cache is not None:
+            cache.close()
+
+    if table is not None:
+        write_check_results(table, args.table, args.timepoint)
+
+    if args.duplicates:
+        if args.index:
+            index = FingerprintIndex.load(args.index)
+        else:
+            index = FingerprintIndex()
+        index.update(args.paths)
+        if args.index:
+            index.save(args.index)
+        for paths in index.duplicate_archives():
+            print('identical ZIP files: {0}'.format(', '.join(paths)))
+        for folders in index.duplicate_folders():
+            print('identical folders: {0}'.format(
+                ', '.join('{0}:{1}'.format(path, d) for path, d in folders)))
+
+    print('checked {0} ZIP files: {1} passed, {2} failed with {3} error(s)'
+          .format(checked, checked - failed, failed, errors))
+
+
+if __name__ == "__main__":
+    main()